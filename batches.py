@@ -0,0 +1,88 @@
+import asyncio
+import os
+import posixpath
+import tempfile
+import zipfile
+
+from downloads import HashingWriter
+
+ZIP_MIME_TYPES = ['application/zip', 'application/x-zip-compressed']
+BATCH_EXTENSIONS = ('.docx', '.pdf')  # What count_words can read
+
+class BatchTooLarge(Exception):
+    """Raised when an archive holds more, or bigger, documents than a batch allows."""
+
+def is_zip(document):
+    """Whether a Telegram document is a zip archive, judging by its MIME type or name."""
+    return document.mime_type in ZIP_MIME_TYPES or (document.file_name or '').lower().endswith('.zip')
+
+def list_zip_documents(archive_path, max_files=50, max_total_size=200 * 1024 * 1024):
+    """Returns the members of a zip archive that can be counted, in archive order.
+
+    Folders, macOS resource forks and other file types are skipped. Raises
+    BatchTooLarge if there are more than max_files documents or they would
+    unpack to more than max_total_size bytes.
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        members = [member for member in archive.infolist()
+                   if not member.is_dir()
+                   and not member.filename.startswith('__MACOSX/')
+                   and not posixpath.basename(member.filename).startswith('.')
+                   and member.filename.lower().endswith(BATCH_EXTENSIONS)]
+    if len(members) > max_files:
+        raise BatchTooLarge(f"The archive holds {len(members)} documents; at most {max_files} can be counted at once.")
+    if sum(member.file_size for member in members) > max_total_size:
+        raise BatchTooLarge(f"The documents in the archive are larger than {max_total_size // (1024 * 1024)} MB in total.")
+    return members
+
+def extract_zip_member(archive_path, member, dest_path, max_size=50 * 1024 * 1024, chunk_size=65536):
+    """Streams one archive member to dest_path and returns (sha256 hex digest, size).
+
+    Only one chunk is held in memory, and the copy stops at max_size bytes
+    even if the archive understates the member's size. Like
+    download_to_file(), a failed extraction leaves no partial file behind.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path) or '.', prefix='.extract-', suffix='.part')
+    try:
+        with zipfile.ZipFile(archive_path) as archive, archive.open(member) as source, os.fdopen(fd, 'wb') as temp_file:
+            writer = HashingWriter(temp_file)
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                if writer.size + len(chunk) > max_size:
+                    raise BatchTooLarge(f"{member.filename} is larger than {max_size // (1024 * 1024)} MB.")
+                writer.write(chunk)
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return writer.sha256.hexdigest(), writer.size
+
+class MediaGroupCollector:
+    """Gathers the messages of a Telegram media group, which arrive as separate updates.
+
+    Once no message has arrived for a group in delay seconds,
+    on_complete(messages) is called with all of them in arrival order.
+    """
+
+    def __init__(self, on_complete, delay=1.0):
+        self.on_complete = on_complete
+        self.delay = delay
+        self.groups = {}
+        self.tasks = set()
+
+    def add(self, message):
+        loop = asyncio.get_running_loop()
+        messages, timer = self.groups.get(message.media_group_id, ([], None))
+        if timer is not None:
+            timer.cancel()
+        messages.append(message)
+        timer = loop.call_later(self.delay, self._complete, message.media_group_id)
+        self.groups[message.media_group_id] = (messages, timer)
+
+    def _complete(self, media_group_id):
+        messages, _ = self.groups.pop(media_group_id)
+        task = asyncio.create_task(self.on_complete(messages))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
@@ -1,12 +1,38 @@
 import os
+import sys
 import logging
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.utils import executor
+from aiogram.utils.exceptions import BadRequest
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
-from docx import Document
-import fitz  # PyMuPDF
-import shutil
+import asyncio
+import contextvars
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from batches import BatchTooLarge, MediaGroupCollector, extract_zip_member, is_zip, list_zip_documents
+from cache import WordCountCache, FileIdCache, ReportCache
+from conversation import Conversation, ANY_STEP, normalize
+from downloads import download_to_file
+from document_ids import DocumentIdAllocator, read_legacy_counter
+from features import WORDCOUNT, SAVE, TURNITIN, WORD_MIME_TYPES, DOCUMENT_MIME_TYPES, TurnitinFeature, parse_features
+from jobs import JobQueue, AsyncWorkers, PermanentJobError, RetryLater
+from loop_watchdog import LoopWatchdog, WatchdogMiddleware
+from outbox import Outbox, EDIT, DOCUMENT
+from similarity import (SimilarityIndex, document_signature, count_words_with_signature, count_pdf_pages_with_signature,
+                        combine_sketches)
+from metrics import (Counter, Gauge, InstrumentedBot, MetricsMiddleware, HANDLER_ERRORS, HANDLER_LATENCY, DOWNLOAD_BYTES,
+                     DOWNLOAD_SPEED, WORD_COUNT_SECONDS, WORD_COUNT_PAGE_SECONDS, span, start_metrics_server)
+from state import create_state_store
+from storage import DocumentStore
+from startup import FirstUpdateLogger, process_uptime, profile_imports
+from throttling import ThrottlingMiddleware
+from webhook import start_webhook
+from wordcount import preload_backends, count_words, count_pdf_pages, count_words_in_pdf_pages, pdf_page_ranges, combine_counts
 
 # Load environment variables from .env file
 load_dotenv()
@@ -22,31 +48,381 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 if BOT_TOKEN is None:
     raise ValueError("Bot token is not defined. Please set BOT_TOKEN in your .env file.")
 
-bot = Bot(token=BOT_TOKEN)
+# Optional self-hosted (or fake, for load tests) Bot API server
+TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER')
+
+if TELEGRAM_API_SERVER:
+    bot = InstrumentedBot(token=BOT_TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_SERVER))
+else:
+    bot = InstrumentedBot(token=BOT_TOKEN)
 dp = Dispatcher(bot)
 
+# Everything the bot sends goes through one queue that keeps it inside Telegram's flood limits
+outbox = Outbox(
+    per_chat_rate=float(os.getenv('OUTBOX_CHAT_RATE', '1')),
+    per_chat_burst=int(os.getenv('OUTBOX_CHAT_BURST', '3')),
+    global_rate=float(os.getenv('OUTBOX_GLOBAL_RATE', '30')),
+    global_burst=int(os.getenv('OUTBOX_GLOBAL_BURST', '30')),
+)
+
+# Helper functions to send through the outbox; short replies go ahead of progress edits and documents.
+# The calls run in the outbox's task, so they use bot directly rather than the current-bot context of message.reply
+async def reply(message: types.Message, text, **kwargs):
+    return await send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+async def send_message(chat_id, text, **kwargs):
+    return await outbox.send(lambda: bot.send_message(chat_id, text, **kwargs), chat_id)
+
+# Which of the bots this process runs, e.g. BOT_FEATURES=wordcount,turnitin
+# They all answer on BOT_TOKEN, so combining them merges the bots rather than hosting each one:
+# with wordcount on, text is no longer echoed, and with save or turnitin on, a document sent outside
+# the wordcount flow is saved (and checked) instead of getting the "follow the sequence" reply.
+# Run one process per token to keep the bots apart.
+BOT_FEATURES = parse_features(os.getenv('BOT_FEATURES', WORDCOUNT))
+
+if TURNITIN in BOT_FEATURES:
+    turnitin_feature = TurnitinFeature(bot, os.getenv('TURNITIN_API_URL'), os.getenv('TURNITIN_API_KEY'),
+                                       max_concurrent=int(os.getenv('TURNITIN_MAX_CONCURRENT', '5')), reply=reply)
+else:
+    turnitin_feature = None
+
 # Create an uploads directory if it doesn't exist
 os.makedirs('uploads', exist_ok=True)
 
-# Dictionary to keep track of user states and document IDs
-user_states = {}
-user_documents = {}
+# Conversation state is kept in a pluggable store so it survives restarts and can be shared between processes
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+STATE_TTL = int(os.getenv('STATE_TTL', '86400'))  # Seconds before an abandoned conversation is forgotten
+
+state_store = create_state_store(
+    STATE_BACKEND,
+    ttl=STATE_TTL,
+    db_path=os.getenv('STATE_DB', 'uploads/state.db'),
+    redis_url=os.getenv('REDIS_URL', 'redis://localhost:6379/0'),
+)
 
-# Initialize document ID counter file
+# Helper function to get a user's conversation state
+async def get_user_state(user_id):
+    return await state_store.get(user_id) or {}
+
+# Document IDs are allocated from a database shared by all bot processes
 COUNTER_FILE = 'uploads/counter.txt'
+DOCUMENT_ID_DB = os.getenv('DOCUMENT_ID_DB', 'uploads/document_ids.db')
+DOCUMENT_ID_BLOCK_SIZE = int(os.getenv('DOCUMENT_ID_BLOCK_SIZE', '10'))
+
+# Carry on numbering from the old counter file the first time the database is created
+document_ids = DocumentIdAllocator(DOCUMENT_ID_DB, block_size=DOCUMENT_ID_BLOCK_SIZE,
+                                   start_after=read_legacy_counter(COUNTER_FILE))
 
 # Function to get the next document ID
 def get_next_document_id():
-    if not os.path.exists(COUNTER_FILE):
-        with open(COUNTER_FILE, 'w') as f:
-            f.write('1')
-        return 1
-    with open(COUNTER_FILE, 'r') as f:
-        count = int(f.read().strip())
-    count += 1
-    with open(COUNTER_FILE, 'w') as f:
-        f.write(str(count))
-    return count
+    return document_ids.allocate()
+
+# Uploaded documents are sharded by ID, deduplicated by content and expired by a background sweeper
+DAY = 86400
+document_store = DocumentStore(
+    'uploads',
+    os.getenv('STORAGE_DB', 'uploads/storage.db'),
+    retention=float(os.getenv('STORAGE_RETENTION_DAYS', '30')) * DAY,
+    quota=int(float(os.getenv('STORAGE_QUOTA_MB', '0')) * 1024 * 1024),
+    compress_after=float(os.getenv('STORAGE_COMPRESS_AFTER_DAYS', '0')) * DAY,  # Needs zstandard
+)
+STORAGE_SWEEP_INTERVAL = float(os.getenv('STORAGE_SWEEP_INTERVAL', '3600'))
+
+# Word counts of documents we've already seen, so identical re-uploads skip counting
+WORD_COUNT_CACHE_DB = os.getenv('WORD_COUNT_CACHE_DB', 'uploads/cache.db')
+WORD_COUNT_CACHE_SIZE = int(os.getenv('WORD_COUNT_CACHE_SIZE', '10000'))
+
+word_count_cache = WordCountCache(WORD_COUNT_CACHE_DB, max_entries=WORD_COUNT_CACHE_SIZE)
+
+# Telegram file_ids of files we send back, so each one is only uploaded once
+file_id_cache = FileIdCache(WORD_COUNT_CACHE_DB)
+
+# Turnitin reports of checked documents, so a near-duplicate gets the earlier report instead of a new check
+report_cache = ReportCache(WORD_COUNT_CACHE_DB)
+if turnitin_feature is not None:
+    turnitin_feature.reports = report_cache
+
+# MinHash signatures of every stored submission, to flag near-duplicates; SIMILARITY_DB= turns it off
+SIMILARITY_DB = os.getenv('SIMILARITY_DB', 'uploads/similarity.db')
+SIMILARITY_THRESHOLD = float(os.getenv('SIMILARITY_THRESHOLD', '0.8'))  # Estimated Jaccard similarity to flag
+SIMILARITY_TOP = int(os.getenv('SIMILARITY_TOP', '3'))
+
+similarity_index = SimilarityIndex(SIMILARITY_DB) if SIMILARITY_DB else None
+if similarity_index is not None:
+    # Documents the store sweeps away stop turning up as matches
+    document_store.on_remove = similarity_index.remove_path
+
+# Document submissions are processed by background workers from a durable job queue
+JOB_DB = os.getenv('JOB_DB', 'uploads/jobs.db')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+JOB_QUEUE_LIMIT = int(os.getenv('JOB_QUEUE_LIMIT', '500'))  # Uploads are refused once this many are waiting
+
+job_queue = JobQueue(JOB_DB, max_attempts=JOB_MAX_ATTEMPTS)
+
+# Word counting runs in a process pool so large documents don't block the event loop
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', os.cpu_count() or 1))
+EXTRACTION_TIMEOUT = float(os.getenv('EXTRACTION_TIMEOUT', '120'))
+EXTRACTION_QUEUE_SIZE = int(os.getenv('EXTRACTION_QUEUE_SIZE', '50'))
+EXTRACTION_BUSY_DELAY = float(os.getenv('EXTRACTION_BUSY_DELAY', '5'))  # Seconds before a job retries when the queue is full
+PDF_PAGES_PER_CHUNK = int(os.getenv('PDF_PAGES_PER_CHUNK', '25'))
+PROGRESS_INTERVAL = 2  # Minimum seconds between progress message edits
+
+# PyMuPDF is only imported in the workers, which load it as they start
+def create_extraction_pool():
+    return ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, initializer=preload_backends)
+
+extraction_pool = create_extraction_pool()
+# Held while a broken pool is replaced, so callers that find it broken at the same time only replace it once
+extraction_pool_lock = threading.Lock()
+
+# Once a worker dies (e.g. killed for running out of memory) the pool refuses all work, so start a new one
+def replace_broken_pool(broken):
+    global extraction_pool
+    with extraction_pool_lock:
+        if extraction_pool is broken:
+            logger.error("An extraction worker died, starting a new process pool")
+            extraction_pool = create_extraction_pool()
+            broken.shutdown(wait=False, cancel_futures=True)
+
+# Number of documents currently waiting for or being counted
+extraction_jobs = 0
+
+class ExtractionQueueFull(RetryLater):
+    """Raised when the extraction queue has no room for another document, so its job waits and tries again."""
+
+class DocumentUnreadable(PermanentJobError):
+    """Raised when a worker couldn't read a document, e.g. a corrupt PDF or an old .doc file."""
+
+def check_extraction_queue():
+    if extraction_jobs >= EXTRACTION_WORKERS + EXTRACTION_QUEUE_SIZE:
+        raise ExtractionQueueFull(EXTRACTION_BUSY_DELAY)
+
+class ExtractionSlot:
+    """A document's place in the extraction queue.
+
+    It is held until the document's counting has finished and so has every
+    pool task it started, since a worker keeps counting a page range after
+    we stop waiting for it.
+    """
+
+    def __init__(self, loop):
+        global extraction_jobs
+        self.loop = loop
+        self.holders = 1  # The counting itself
+        extraction_jobs += 1
+
+    def hold_until_done(self, future):
+        self.holders += 1
+        future.add_done_callback(self._release_soon)
+
+    def _release_soon(self, future):
+        # Pool futures call back from the executor's thread
+        try:
+            self.loop.call_soon_threadsafe(self.release)
+        except RuntimeError:
+            pass  # The loop closed while shutting down
+
+    def release(self):
+        global extraction_jobs
+        self.holders -= 1
+        if self.holders == 0:
+            extraction_jobs -= 1
+
+current_extraction_slot = contextvars.ContextVar('current_extraction_slot', default=None)
+
+# Function to run a CPU-heavy extraction function in the process pool
+async def run_extraction(func, *args):
+    pool = extraction_pool
+    try:
+        future = pool.submit(func, *args)
+    except BrokenProcessPool:
+        # Another document broke the pool, so this one can go straight to the new pool
+        replace_broken_pool(pool)
+        pool = extraction_pool
+        future = pool.submit(func, *args)
+    slot = current_extraction_slot.get()
+    if slot is not None:
+        slot.hold_until_done(future)
+    try:
+        return await asyncio.wrap_future(future)
+    except BrokenProcessPool:
+        # This document may be what killed the worker, so it only gets the new pool when its job is retried
+        replace_broken_pool(pool)
+        raise
+    except Exception as e:
+        # Reading the same file again would fail the same way
+        raise DocumentUnreadable(f"{type(e).__name__}: {e}") from e
+
+# Function to count the words in a document, calling progress(pages_done, page_count, word_count) for PDFs without awaiting it
+# Returns (word count, whether the bibliography was left out, signature); with sign, the similarity signature is made
+# from the same read of the document, otherwise it is None
+async def count_document_words(file_path, progress=None, exclude_quotes=False, exclude_bibliography=False, sign=False):
+    check_extraction_queue()
+    slot = ExtractionSlot(asyncio.get_running_loop())
+    # Tasks started from here on inherit the slot, so their pool futures hold it too
+    token = current_extraction_slot.set(slot)
+    try:
+        return await asyncio.wait_for(_count_document_words(file_path, progress, exclude_quotes, exclude_bibliography, sign),
+                                      timeout=EXTRACTION_TIMEOUT)
+    finally:
+        current_extraction_slot.reset(token)
+        slot.release()
+
+# Returns (pages, (words, words before references), sketch part or None)
+async def _count_pdf_chunk(file_path, start, stop, exclude_quotes, exclude_bibliography, sign):
+    started = time.perf_counter()
+    if sign:
+        counted, part = await run_extraction(count_pdf_pages_with_signature, file_path, start, stop,
+                                             exclude_quotes, exclude_bibliography)
+    else:
+        counted = await run_extraction(count_words_in_pdf_pages, file_path, start, stop, exclude_quotes, exclude_bibliography)
+        part = None
+    WORD_COUNT_PAGE_SECONDS.observe((time.perf_counter() - started) / max(stop - start, 1))
+    return stop - start, counted, part
+
+async def _count_document_words(file_path, progress, exclude_quotes, exclude_bibliography, sign):
+    started = time.perf_counter()
+    document_type = os.path.splitext(file_path)[1].lstrip('.').lower() or 'unknown'
+    with span("count_words", document_type=document_type):
+        try:
+            return await _count_document_words_by_type(file_path, progress, exclude_quotes, exclude_bibliography, sign)
+        finally:
+            WORD_COUNT_SECONDS.labels(document_type).observe(time.perf_counter() - started)
+
+async def _count_document_words_by_type(file_path, progress, exclude_quotes, exclude_bibliography, sign):
+    if not file_path.endswith('.pdf'):
+        if sign:
+            (word_count, bibliography_excluded), signature = await run_extraction(
+                count_words_with_signature, file_path, exclude_quotes, exclude_bibliography)
+            return word_count, bibliography_excluded, signature
+        return (*await run_extraction(count_words, file_path, exclude_quotes, exclude_bibliography), None)
+
+    # Split the PDF into page ranges so several workers can count it at once
+    page_count = await run_extraction(count_pdf_pages, file_path)
+    chunks = [asyncio.ensure_future(_count_pdf_chunk(file_path, start, stop, exclude_quotes, exclude_bibliography, sign))
+              for start, stop in pdf_page_ranges(page_count, PDF_PAGES_PER_CHUNK)]
+    try:
+        pages_done = 0
+        word_count = 0
+        for chunk in asyncio.as_completed(chunks):
+            pages, (words, _), _ = await chunk
+            pages_done += pages
+            word_count += words
+            if progress is not None and len(chunks) > 1:
+                progress(pages_done, page_count, word_count)
+        # The bibliography can only be dropped once every range is counted and they are back in page order
+        word_count, bibliography_excluded = combine_counts(chunk.result()[1] for chunk in chunks)
+        signature = combine_sketches(chunk.result()[2] for chunk in chunks) if sign else None
+        return word_count, bibliography_excluded, signature
+    finally:
+        # Drop chunks that haven't started yet if we gave up on this document
+        for chunk in chunks:
+            chunk.cancel()
+
+# Function to index a stored document and return [(document_id, similarity)] for earlier ones it nearly duplicates
+# A signature made while counting the document is passed in, so the document isn't read a second time
+async def find_similar_documents(document_id, file_path, content_hash, signature=None):
+    if similarity_index is None:
+        return []
+    # Identical content has the same signature, so it doesn't need reading again
+    if signature is None:
+        signature = similarity_index.get_signature(content_hash)
+    if signature is None:
+        try:
+            signature = await asyncio.wait_for(run_extraction(document_signature, file_path), timeout=EXTRACTION_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Could not compute the signature of document {document_id}: {e}")
+            return []
+        if signature is None:  # No words to compare
+            return []
+    matches = similarity_index.query(signature, top=SIMILARITY_TOP, min_similarity=SIMILARITY_THRESHOLD, exclude=document_id)
+    similarity_index.add(document_id, signature, content_hash, file_path)
+    return matches
+
+def describe_matches(matches):
+    return ", ".join(f"Document {document_id} ({score:.0%})" for document_id, score in matches)
+
+# Progress messages being sent, kept so they aren't garbage collected and can be cancelled at shutdown
+progress_tasks = set()
+
+# Helper function to show counting progress in a single message that is edited as pages are counted
+# Progress is best effort: it is sent in the background, so a failed or rate limited edit never holds up counting
+def create_progress_reporter(chat_id, reply_to_message_id):
+    status_message = None
+    last_update = 0
+    sending = None
+
+    async def send_progress(text):
+        nonlocal status_message
+        try:
+            if status_message is None:
+                status_message = await send_message(chat_id, text, reply_to_message_id=reply_to_message_id)
+            else:
+                await outbox.send(lambda: bot.edit_message_text(text, chat_id, status_message.message_id), chat_id, EDIT)
+        except Exception as e:
+            logger.warning(f"Could not update the progress message in chat {chat_id}: {e}")
+
+    def report_progress(pages_done, page_count, word_count):
+        nonlocal last_update, sending
+        now = time.monotonic()
+        # Skip updates while the previous one is still going out
+        if sending is not None and not sending.done():
+            return
+        if pages_done < page_count and now - last_update < PROGRESS_INTERVAL:
+            return
+        last_update = now
+        text = f"Counting words... {pages_done}/{page_count} pages ({word_count} words so far)"
+        sending = asyncio.create_task(send_progress(text))
+        progress_tasks.add(sending)
+        sending.add_done_callback(progress_tasks.discard)
+
+    return report_progress
+
+# Rate limit users and the bot as a whole, and refuse uploads once the job queue is too deep
+dp.middleware.setup(FirstUpdateLogger(logger))
+dp.middleware.setup(ThrottlingMiddleware(
+    user_rate=float(os.getenv('THROTTLE_USER_RATE', '1')),
+    user_burst=int(os.getenv('THROTTLE_USER_BURST', '10')),
+    global_rate=float(os.getenv('THROTTLE_GLOBAL_RATE', '30')),
+    global_burst=int(os.getenv('THROTTLE_GLOBAL_BURST', '100')),
+    document_cost=int(os.getenv('THROTTLE_DOCUMENT_COST', '5')),
+    backlog=job_queue.depth,
+    max_backlog=JOB_QUEUE_LIMIT,
+    reply=reply,
+))
+
+# Dump a sampled stack profile whenever something blocks the event loop for longer than the budget
+WATCHDOG_ENABLED = os.getenv('WATCHDOG_ENABLED', '1') == '1'
+watchdog = LoopWatchdog(
+    budget=float(os.getenv('WATCHDOG_BUDGET_MS', '100')) / 1000,
+    sample_interval=float(os.getenv('WATCHDOG_SAMPLE_MS', '10')) / 1000,
+    output_dir=os.getenv('WATCHDOG_DIR', 'uploads/watchdog'),
+)
+if WATCHDOG_ENABLED:
+    dp.middleware.setup(WatchdogMiddleware(watchdog, handler_budget=float(os.getenv('WATCHDOG_HANDLER_BUDGET_MS', '2000')) / 1000))
+
+# Time every handler that gets past the rate limits; METRICS_PORT serves them in Prometheus format
+dp.middleware.setup(MetricsMiddleware())
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 leaves the /metrics endpoint off
+metrics_runner = None
+
+Gauge('bot_jobs', 'Jobs in the job queue by status.', ['status'],
+      function=lambda: {status: count for status, count in job_queue.stats().items() if status in ('queued', 'running', 'failed')})
+Counter('bot_jobs_completed_total', 'Jobs completed since start.', function=lambda: job_queue.completed)
+Counter('bot_jobs_retried_total', 'Job attempts that failed and were retried since start.', function=lambda: job_queue.retried)
+Gauge('bot_outbox_queued', 'Bot API calls waiting in the outbox.', function=outbox.depth)
+Counter('bot_outbox_retried_total', 'Bot API calls the outbox retried after flood control or network errors.',
+        function=lambda: outbox.retried)
+Counter('bot_word_count_cache_hits_total', 'Word counts answered from the cache.', function=lambda: word_count_cache.hits)
+Counter('bot_word_count_cache_misses_total', 'Word count cache lookups that found nothing.', function=lambda: word_count_cache.misses)
+Gauge('bot_storage_bytes', 'Bytes the stored documents take up on disk.', function=document_store.usage)
+Gauge('bot_extraction_jobs', 'Documents waiting for or being counted by the extraction pool.', function=lambda: extraction_jobs)
+
+@dp.errors_handler()
+async def count_handler_error(update: types.Update, exception):
+    HANDLER_ERRORS.labels(type(exception).__name__).inc()
 
 # Helper function to create the custom keyboard
 def create_initial_keyboard():
@@ -64,162 +440,575 @@ def create_yesNo_keyboard():
     keyboard.add(KeyboardButton("YES"), KeyboardButton("NO"))
     return keyboard
 
-def count_words_in_docx(file_path):
-    """Counts the number of words in a DOCX file."""
-    doc = Document(file_path)
-    word_count = 0
-    for para in doc.paragraphs:
-        word_count += len(para.text.split())
-    return word_count
-
-def count_words_in_pdf(file_path):
-    """Counts the number of words in a PDF file."""
-    doc = fitz.open(file_path)
-    word_count = 0
-    for page in doc:
-        text = page.get_text()
-        word_count += len(text.split())
-    return word_count
-
-def count_words(file_path):
-    """Determines the file type and counts words accordingly."""
-    if file_path.endswith('.docx'):
-        return count_words_in_docx(file_path)
-    elif file_path.endswith('.pdf'):
-        return count_words_in_pdf(file_path)
+# Helper function to describe the user's Bibliography and Quotes choices
+def describe_choices(user_state):
+    bibliography = user_state.get("exclude_bibliography")
+    quotes = user_state.get("exclude_quotes")
+    if bibliography and quotes:
+        return "exclude both Bibliography and Quotes"
+    elif bibliography:
+        return "exclude Bibliography but include Quotes"
+    elif quotes:
+        return "include Bibliography but exclude Quotes"
     else:
-        raise ValueError("Unsupported file type. Please upload a DOCX or PDF file.")
+        return "include both Bibliography and Quotes"
+
+# Helper function to turn the choices into a short cache key, e.g. "bq" when both are excluded
+def count_options_key(exclude_bibliography, exclude_quotes):
+    return ("b" if exclude_bibliography else "") + ("q" if exclude_quotes else "")
 
 # Command handler for /start
 @dp.message_handler(commands=['start'])
 async def send_welcome(message: types.Message):
+    if WORDCOUNT not in BOT_FEATURES:
+        await send_greeting(message)
+        return
     user_id = message.from_user.id
-    user_states[user_id] = {"step": "start"}
-    await message.reply("Enter your subscription region:", reply_markup=create_region_keyboard())
+    await state_store.set(user_id, {"step": "start"})
+    await reply(message, "Enter your subscription region:", reply_markup=create_region_keyboard())
+
+# Command handler for /hello
+@dp.message_handler(commands=['hello'])
+async def send_greeting(message: types.Message):
+    await reply(message, "Collins, how are you doing?")
 
 # Command handler for /help
 @dp.message_handler(commands=['help'])
 async def send_help(message: types.Message):
-    user_id = message.from_user.id
-    state = user_states.get(user_id, {}).get("step")
-    await message.reply("Help information provided. You can now select an option:", reply_markup=create_region_keyboard())
-
-# Command handler for region selection
-@dp.message_handler(lambda message: message.text.lower() == "\U0001F30D turnitin intl")
-async def handle_region(message: types.Message):
-    user_id = message.from_user.id
-    state = user_states.get(user_id, {}).get("step")
-
-    if state == "start":
-        user_states[user_id]["step"] = "bibliography_prompt"
-        await message.reply("Do you want to exclude Bibliography?", reply_markup=create_yesNo_keyboard())
+    await reply(message, "Help information provided. You can now select an option:", reply_markup=create_region_keyboard())
+
+# The region, bibliography and quotes steps are driven by a transition table
+conversation = Conversation()
+REGION_BUTTON = "\U0001F30D Turnitin Intl"
+
+# Handler for region selection
+@conversation.on("start", REGION_BUTTON)
+async def handle_region(message: types.Message, user_state, text):
+    user_state["step"] = "bibliography_prompt"
+    await state_store.set(message.from_user.id, user_state)
+    await reply(message, "Do you want to exclude Bibliography?", reply_markup=create_yesNo_keyboard())
+
+@conversation.on(ANY_STEP, REGION_BUTTON)
+async def handle_region_out_of_sequence(message: types.Message, user_state, text):
+    await reply(message, "Please follow the correct sequence: /start, /help, then select your region.")
+
+# Handler for YES/NO response for Bibliography
+@conversation.on("bibliography_prompt", "yes", "no")
+async def handle_bibliography_choice(message: types.Message, user_state, text):
+    user_state["step"] = "quotes_prompt"
+    user_state["exclude_bibliography"] = text == "yes"
+    await state_store.set(message.from_user.id, user_state)
+    await reply(message, "Do you want to exclude Quotes?", reply_markup=create_yesNo_keyboard())
+
+# Handler for YES/NO response for Quotes
+@conversation.on("quotes_prompt", "yes", "no")
+async def handle_quotes_choice(message: types.Message, user_state, text):
+    user_state["step"] = "ready_for_document"
+    user_state["exclude_quotes"] = text == "yes"
+    await state_store.set(message.from_user.id, user_state)
+    await reply(message, f"You have chosen to {describe_choices(user_state)}. Please upload your document.")
+
+@conversation.on(ANY_STEP, "yes", "no")
+async def handle_unexpected_answer(message: types.Message, user_state, text):
+    await reply(message, "Unexpected state. Please follow the correct sequence.")
+
+# Handler for text messages: normalizes the text once and looks up the transition for the user's step
+@dp.message_handler(content_types=['text'])
+async def handle_text(message: types.Message):
+    if WORDCOUNT not in BOT_FEATURES:
+        await reply(message, message.text)
+        return
+    text = normalize(message.text)
+    if not conversation.handles(text):
+        return
+    user_state = await get_user_state(message.from_user.id)
+    handler = conversation.resolve(user_state.get("step"), text)
+    started = time.perf_counter()
+    try:
+        await handler(message, user_state, text)
+    finally:
+        HANDLER_LATENCY.labels(handler.__name__).observe(time.perf_counter() - started)
+
+# Function to send a file, reusing Telegram's copy of it if we've uploaded it before
+async def send_cached_document(chat_id, file_path, caption):
+    file_id = file_id_cache.get(file_path)
+    if file_id is not None:
+        try:
+            return await outbox.send(lambda: bot.send_document(chat_id, file_id, caption=caption), chat_id, DOCUMENT)
+        except BadRequest as e:
+            logger.warning(f"Cached file_id for {file_path} was rejected, uploading again: {e}")
+            file_id_cache.forget(file_path)
+    sent = await outbox.send(lambda: bot.send_document(chat_id, types.InputFile(file_path), caption=caption), chat_id, DOCUMENT)
+    file_id_cache.put(file_path, sent.document.file_id)
+    return sent
+
+# Function to download a document from Telegram, recording how fast it came in
+async def download_document(telegram_file_path, save_path):
+    started = time.perf_counter()
+    with span("download"):
+        content_hash, size = await download_to_file(bot, telegram_file_path, save_path)
+    DOWNLOAD_BYTES.inc(size)
+    DOWNLOAD_SPEED.observe(size / max(time.perf_counter() - started, 1e-6))
+    return content_hash, size
+
+# Function to process a queued document submission and reply with the result
+async def process_document_job(job):
+    with span("document_job", document_id=job["document_id"]):
+        await _process_document_job(job)
+
+async def _process_document_job(job):
+    chat_id = job["chat_id"]
+    message_id = job["message_id"]
+    document_id = job["document_id"]
+    file_name = f"{document_id}_{job['file_name']}"
+
+    exclude_bibliography = job["exclude_bibliography"]
+    exclude_quotes = job["exclude_quotes"]
+    options = count_options_key(exclude_bibliography, exclude_quotes)
+
+    # A re-upload of a file we have already counted doesn't need to be downloaded again
+    counted = word_count_cache.get_by_file_id(job["file_unique_id"], options)
+    if counted is None:
+        file_info = await bot.get_file(job["file_id"])
+        file_path = file_info.file_path
+        file_save_path = document_store.path_for(document_id, job['file_name'])
+
+        # Stream the user's document straight to disk under its unique ID
+        content_hash, size = await download_document(file_path, file_save_path)
+        document_store.add(file_save_path, content_hash, size)
+
+        # Count words in the document without blocking other users
+        try:
+            word_count, bibliography_excluded, signature = await count_saved_document(file_save_path, content_hash, job["file_unique_id"],
+                                                 exclude_quotes, exclude_bibliography,
+                                                 progress=create_progress_reporter(chat_id, message_id))
+        except ExtractionQueueFull:
+            # Told once, as the job is postponed until there is room
+            if not job.get("busy_notified"):
+                job["busy_notified"] = True
+                await send_message(chat_id, "The bot is busy right now. Your document will be counted as soon as possible.",
+                                   reply_to_message_id=message_id)
+            raise
+        except asyncio.TimeoutError:
+            logger.error(f"Word counting timed out for document {document_id}")
+            await send_message(chat_id, "Your document took too long to process. Please try again with a smaller file.",
+                                   reply_to_message_id=message_id)
+            return
+        # A document without words has nothing to compare
+        matches = await find_similar_documents(document_id, file_save_path, content_hash, signature) if word_count else []
     else:
-        await message.reply("Please follow the correct sequence: /start, /help, then select your region.")
-
-# Handler for YES response for Bibliography
-@dp.message_handler(lambda message: message.text.lower() == "yes")
-async def handle_bibliography_yes(message: types.Message):
-    user_id = message.from_user.id
-    state = user_states.get(user_id, {}).get("step")
-
-    if state == "bibliography_prompt":
-        user_states[user_id]["step"] = "quotes_prompt"
-        await message.reply("Do you want to exclude Quotes?", reply_markup=create_yesNo_keyboard())
-    elif state == "quotes_prompt":
-        user_states[user_id]["step"] = "ready_for_document"
-        await message.reply("You have chosen to exclude both Bibliography and Quotes. Please upload your document.")
+        word_count, bibliography_excluded = counted
+        matches = []
+
+    message_text = f"#Submitted\n#Turnitin Intl\nDocument ID: {document_id}\nFile name: {file_name}\nWord count: {word_count}"
+    if matches:
+        message_text += f"\nSimilar to: {describe_matches(matches)}"
+    if exclude_bibliography and not bibliography_excluded:
+        message_text += f"\n{BIBLIOGRAPHY_NOT_FOUND}"
+    await send_report(chat_id, message_id, message_text, exclude_bibliography and bibliography_excluded, exclude_quotes,
+                      caption=f"Here is the document you requested with ID {document_id}.")
+
+# Told when the user chose to exclude the bibliography but none was found after the main text
+BIBLIOGRAPHY_NOT_FOUND = "No bibliography was found after the main text, so it was counted"
+
+# Function to count a downloaded document, unless the same content was counted with the same choices before
+# Returns (word count, whether the bibliography was left out, similarity signature made while counting or None)
+async def count_saved_document(file_path, content_hash, file_unique_id, exclude_quotes, exclude_bibliography, progress=None):
+    options = count_options_key(exclude_bibliography, exclude_quotes)
+    # The same content may have been uploaded before as a different Telegram file
+    counted = word_count_cache.get_by_hash(content_hash, options)
+    signature = None
+    if counted is None:
+        # Content that is already indexed keeps its signature, so it is only made for new content
+        sign = similarity_index is not None and similarity_index.get_signature(content_hash) is None
+        word_count, bibliography_excluded, signature = await count_document_words(
+            file_path, progress, exclude_quotes=exclude_quotes, exclude_bibliography=exclude_bibliography, sign=sign)
+    else:
+        word_count, bibliography_excluded = counted
+    word_count_cache.put(content_hash, file_unique_id, word_count, options, bibliography_excluded)
+    return word_count, bibliography_excluded, signature
+
+# Function to send the final report, followed by the response document if there is one
+async def send_report(chat_id, message_id, message_text, exclude_bibliography, exclude_quotes, caption):
+    # Define the name of the PDF document to send back
+    response_file_name = "response.pdf"  # Ensure this is the correct file name for the response
+    response_file_path = os.path.join('uploads', response_file_name)
+
+    excluded = [name for name, exclude in (("Bibliography", exclude_bibliography), ("Quotes", exclude_quotes)) if exclude]
+    if excluded:
+        message_text += f"\nExcluded: {', '.join(excluded)}"
+
+    if os.path.exists(response_file_path):
+        message_text += "\nFile available ⬇️"
     else:
-        await message.reply("Unexpected state. Please follow the correct sequence.")
+        message_text += "\nThe document to send back is not available ❌"
+
+    # Long batch reports are split on line breaks to stay under Telegram's message size limit
+    for part in split_message(message_text):
+        await send_message(chat_id, part, reply_to_message_id=message_id)
+
+    # Send the document back if it exists
+    if os.path.exists(response_file_path):
+        await send_cached_document(chat_id, response_file_path, caption=caption)
+
+def split_message(text, limit=4096):
+    parts = []
+    for line in text.split("\n"):
+        if parts and len(parts[-1]) + 1 + len(line) <= limit:
+            parts[-1] += "\n" + line
+        else:
+            parts.append(line[:limit])
+    return parts
+
+# Batches: a zip archive or a media group of documents, counted with one set of choices
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', '50'))
+BATCH_MAX_FILE_SIZE = int(os.getenv('BATCH_MAX_FILE_SIZE', str(50 * 1024 * 1024)))  # Per unpacked document
+BATCH_MAX_TOTAL_SIZE = int(os.getenv('BATCH_MAX_TOTAL_SIZE', str(200 * 1024 * 1024)))  # All unpacked documents together
+MEDIA_GROUP_DELAY = float(os.getenv('MEDIA_GROUP_DELAY', '1'))  # Seconds to wait for the rest of a media group
+
+def describe_batch_count(word_count, bibliography_not_found):
+    return f"{word_count} words" + (" (bibliography not found, so it was counted)" if bibliography_not_found else "")
+
+# Function to process a queued batch, replying per document as each is counted and then with a summary
+async def process_batch_job(job):
+    chat_id = job["chat_id"]
+    message_id = job["message_id"]
+    exclude_bibliography = job["exclude_bibliography"]
+    exclude_quotes = job["exclude_quotes"]
+    options = count_options_key(exclude_bibliography, exclude_quotes)
+
+    # Counting is limited to one document per extraction worker so a batch can't fill the extraction queue
+    counting = asyncio.Semaphore(EXTRACTION_WORKERS)
+    # Progress is kept in the job payload, so a retry reuses the document IDs and doesn't report a document twice
+    member_ids = job.setdefault("member_ids", {})  # Archive member name -> document ID
+    done = job.setdefault("done", {})  # Document ID -> [file name, word count, result]
+
+    async def count_file(document_id, file_name, file_path, content_hash, file_unique_id):
+        try:
+            async with counting:
+                word_count, bibliography_excluded, signature = await count_saved_document(
+                    file_path, content_hash, file_unique_id, exclude_quotes, exclude_bibliography)
+            result = describe_batch_count(word_count, exclude_bibliography and not bibliography_excluded)
+        except ExtractionQueueFull:
+            # Postpones the whole batch; documents already counted are kept in the payload
+            raise
+        except asyncio.TimeoutError:
+            logger.error(f"Word counting timed out for document {document_id}")
+            word_count, result = None, "took too long to process"
+        except Exception as e:
+            logger.error(f"Error counting document {document_id}: {e}")
+            word_count, result = None, "could not be counted"
+        if word_count:
+            matches = await find_similar_documents(document_id, file_path, content_hash, signature)
+            if matches:
+                result += f", similar to {describe_matches(matches)}"
+        done[str(document_id)] = [file_name, word_count, result]
+        await send_message(chat_id, f"Document {document_id}: {file_name}\nWord count: {result}", reply_to_message_id=message_id)
+
+    # Documents are counted as soon as they are on disk, while the rest are still being fetched
+    tasks = []
+    try:
+        if "archive" in job:
+            archive = job["archive"]
+            # The archive itself is only kept until its documents are extracted
+            archive_path = os.path.join('uploads', f"{archive['document_id']}_{os.path.basename(archive['file_name'])}")
+            file_info = await bot.get_file(archive["file_id"])
+            await download_document(file_info.file_path, archive_path)
+            try:
+                try:
+                    members = await asyncio.to_thread(list_zip_documents, archive_path, BATCH_MAX_FILES, BATCH_MAX_TOTAL_SIZE)
+                except (BatchTooLarge, zipfile.BadZipFile) as e:
+                    await send_message(chat_id, f"The archive can't be counted: {e}", reply_to_message_id=message_id)
+                    return
+                if not members:
+                    await send_message(chat_id, "The archive doesn't contain any Word documents or PDFs.", reply_to_message_id=message_id)
+                    return
+                for member in members:
+                    if member.filename not in member_ids:
+                        member_ids[member.filename] = get_next_document_id()
+                    document_id = member_ids[member.filename]
+                    if str(document_id) in done:
+                        continue
+                    file_name = f"{document_id}_{os.path.basename(member.filename)}"
+                    file_path = document_store.path_for(document_id, member.filename)
+                    try:
+                        content_hash, size = await asyncio.to_thread(extract_zip_member, archive_path, member, file_path, BATCH_MAX_FILE_SIZE)
+                    except BatchTooLarge as e:
+                        done[str(document_id)] = [file_name, None, "too large"]
+                        await send_message(chat_id, f"Document {document_id}: {e}", reply_to_message_id=message_id)
+                        continue
+                    document_store.add(file_path, content_hash, size)
+                    tasks.append(asyncio.create_task(count_file(document_id, file_name, file_path, content_hash, None)))
+            finally:
+                os.remove(archive_path)
+        else:
+            for file in job["files"]:
+                document_id = file["document_id"]
+                if str(document_id) in done:
+                    continue
+                file_name = f"{document_id}_{file['file_name']}"
+                counted = word_count_cache.get_by_file_id(file["file_unique_id"], options)
+                if counted is not None:
+                    word_count, bibliography_excluded = counted
+                    result = describe_batch_count(word_count, exclude_bibliography and not bibliography_excluded)
+                    done[str(document_id)] = [file_name, word_count, result]
+                    await send_message(chat_id, f"Document {document_id}: {file_name}\nWord count: {result}",
+                                           reply_to_message_id=message_id)
+                    continue
+                file_info = await bot.get_file(file["file_id"])
+                file_path = document_store.path_for(document_id, file['file_name'])
+                content_hash, size = await download_document(file_info.file_path, file_path)
+                document_store.add(file_path, content_hash, size)
+                tasks.append(asyncio.create_task(count_file(document_id, file_name, file_path, content_hash, file["file_unique_id"])))
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    results = [done[document_id] for document_id in sorted(done, key=int)]
+    lines = [f"{file_name}: {result}" for file_name, _, result in results]
+    total = sum(word_count for _, word_count, _ in results if word_count is not None)
+    message_text = f"#Submitted\n#Turnitin Intl\nBatch of {len(results)} documents\n" + "\n".join(lines) + f"\nTotal word count: {total}"
+    await send_report(chat_id, message_id, message_text, exclude_bibliography, exclude_quotes,
+                      caption=f"Here is the document you requested for your batch of {len(results)} documents.")
+
+# Called once a document or batch job has failed on every attempt
+async def document_job_failed(job, error):
+    logger.error(f"Error handling {job.kind} job {job.id}: {error}")
+    if isinstance(error, DocumentUnreadable):
+        text = "Your document could not be read. Please upload a valid Word document (.docx) or PDF."
+    else:
+        text = "An error occurred while processing your document. Please try again."
+    await send_message(job.payload["chat_id"], text, reply_to_message_id=job.payload["message_id"])
 
-# Handler for NO response for Bibliography
-@dp.message_handler(lambda message: message.text.lower() == "no")
-async def handle_bibliography_no(message: types.Message):
-    user_id = message.from_user.id
-    state = user_states.get(user_id, {}).get("step")
-
-    if state == "bibliography_prompt":
-        user_states[user_id]["step"] = "quotes_prompt"
-        await message.reply("Do you want to exclude Quotes?", reply_markup=create_yesNo_keyboard())
-    elif state == "quotes_prompt":
-        user_states[user_id]["step"] = "ready_for_document"
-        await message.reply("You have chosen to include Bibliography but exclude Quotes. Please upload your document.")
+# Names the job a worker is running, so the watchdog can tell which one blocked the loop
+def watched_job(kind, handler):
+    async def run(job):
+        watchdog.track(f"{kind} job for message {job['message_id']} in chat {job['chat_id']}")
+        try:
+            return await handler(job)
+        finally:
+            watchdog.untrack()
+    return run
+
+document_workers = AsyncWorkers(job_queue, {"document": watched_job("document", process_document_job),
+                                            "batch": watched_job("batch", process_batch_job)},
+                                workers=JOB_WORKERS, on_failure=document_job_failed)
+
+# Function to save an uploaded document under a fresh ID, returning (document ID, path, content hash)
+async def save_document(message: types.Message):
+    document_id = get_next_document_id()
+    file_path = document_store.path_for(document_id, message.document.file_name)
+    file = await bot.get_file(message.document.file_id)
+    content_hash, size = await download_document(file.file_path, file_path)
+    document_store.add(file_path, content_hash, size)
+    return document_id, file_path, content_hash
+
+# Handler for word count submissions
+async def handle_wordcount_document(message: types.Message, user_state):
+    try:
+        mime_type = message.document.mime_type
+        if message.media_group_id and mime_type in DOCUMENT_MIME_TYPES:
+            # The rest of the group arrives as separate messages; they are queued together once it's complete
+            media_groups.add(message)
+        elif is_zip(message.document):
+            archive_id = get_next_document_id()
+            job_id = job_queue.enqueue("batch", {
+                "chat_id": message.chat.id,
+                "message_id": message.message_id,
+                "archive": {"document_id": archive_id, "file_id": message.document.file_id, "file_name": message.document.file_name},
+                "exclude_bibliography": user_state.get("exclude_bibliography", False),
+                "exclude_quotes": user_state.get("exclude_quotes", False),
+            })
+            document_workers.notify()
+            await reply_queued(message, job_id, "Archive received")
+        elif mime_type in DOCUMENT_MIME_TYPES:
+            # Generate a unique ID for the document and leave the rest to the workers
+            document_id = get_next_document_id()
+            job_id = job_queue.enqueue("document", {
+                "chat_id": message.chat.id,
+                "message_id": message.message_id,
+                "document_id": document_id,
+                "file_id": message.document.file_id,
+                "file_unique_id": message.document.file_unique_id,
+                "file_name": message.document.file_name,
+                "exclude_bibliography": user_state.get("exclude_bibliography", False),
+                "exclude_quotes": user_state.get("exclude_quotes", False),
+            })
+            document_workers.notify()
+
+            await reply_queued(message, job_id, f"Document {document_id} received")
+        else:
+            await reply(message, "Unsupported file type. Please upload a Word document, a PDF or a zip of them.")
+    except Exception as e:
+        logger.error(f"Error handling document: {e}")
+        await reply(message, "An error occurred while processing your document. Please try again.")
+
+# Helper function to tell the user where their job is in the queue
+async def reply_queued(message: types.Message, job_id, received):
+    position = job_queue.position(job_id)
+    if position > 0:
+        await reply(message, f"{received}. It is number {position} in the queue, please wait...")
     else:
-        await message.reply("Unexpected state. Please follow the correct sequence.")
+        await reply(message, f"{received}. Counting words...")
+
+# Called with every message of a media group of documents once the whole group has arrived
+async def queue_media_group(messages):
+    first = messages[0]
+    try:
+        user_state = await get_user_state(first.from_user.id)
+        files = [{
+            "document_id": get_next_document_id(),
+            "file_id": message.document.file_id,
+            "file_unique_id": message.document.file_unique_id,
+            "file_name": message.document.file_name,
+        } for message in messages]
+        job_id = job_queue.enqueue("batch", {
+            "chat_id": first.chat.id,
+            "message_id": first.message_id,
+            "files": files,
+            "exclude_bibliography": user_state.get("exclude_bibliography", False),
+            "exclude_quotes": user_state.get("exclude_quotes", False),
+        })
+        document_workers.notify()
+        document_ids = ", ".join(str(file["document_id"]) for file in files)
+        await reply_queued(first, job_id, f"{len(files)} documents received ({document_ids})")
+    except Exception as e:
+        logger.error(f"Error handling media group: {e}")
+        await reply(first, "An error occurred while processing your documents. Please try again.")
+
+media_groups = MediaGroupCollector(queue_media_group, delay=MEDIA_GROUP_DELAY)
+
+# Handler for documents that are only saved, and checked with Turnitin if that's enabled
+async def handle_saved_document(message: types.Message):
+    accepted = WORD_MIME_TYPES if SAVE not in BOT_FEATURES else DOCUMENT_MIME_TYPES
+    if message.document.mime_type not in accepted:
+        await reply(message, "Please upload a Word document." if accepted is WORD_MIME_TYPES else "Please upload a Word document or PDF.")
+        return
+    try:
+        document_id, file_path, content_hash = await save_document(message)
+    except Exception as e:
+        logger.error(f"Error saving document: {e}")
+        await reply(message, "An error occurred while saving your document. Please try again.")
+        return
+    await reply(message, f"Received and saved the document: {file_path}")
+
+    # A resubmission of a document that was already checked gets the earlier report without spending a Turnitin check
+    matches = await find_similar_documents(document_id, file_path, content_hash)
+    checking = turnitin_feature is not None and message.document.mime_type in WORD_MIME_TYPES
+    if matches:
+        text = f"This document is a near-duplicate of {describe_matches(matches)}."
+        earlier = None
+        for match_id, _ in matches:
+            report_url = report_cache.get(match_id)
+            if report_url is not None:
+                earlier = match_id, report_url
+                break
+        if checking and earlier is not None:
+            match_id, report_url = earlier
+            report_cache.put(document_id, report_url)
+            await reply(message, f"{text} It was not sent to Turnitin again.\nTurnitin Report URL (Document {match_id}): {report_url}")
+            return
+        if checking:
+            text += " No earlier Turnitin report is available, so it is being checked."
+        await reply(message, text)
+
+    # Upload the document to Turnitin; the report is sent to the user once it is ready
+    if checking:
+        turnitin_feature.check(message, file_path, document_id)
 
 # Handler for document submissions
 @dp.message_handler(content_types=['document'])
 async def handle_document(message: types.Message):
-    user_id = message.from_user.id
-    state = user_states.get(user_id, {}).get("step")
-
-    if state == "ready_for_document":
-        try:
-            mime_type = message.document.mime_type
-            if mime_type in ['application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'application/pdf']:
-                file_info = await bot.get_file(message.document.file_id)
-                file_path = file_info.file_path
-                downloaded_file = await bot.download_file(file_path)
-
-                # Generate a unique ID for the document
-                document_id = get_next_document_id()
-                file_name = f"{document_id}_{message.document.file_name}"
-                file_save_path = os.path.join('uploads', file_name)
-
-                # Save the user's document with the unique ID
-                with open(file_save_path, 'wb') as new_file:
-                    new_file.write(downloaded_file.getvalue())
-
-                # Count words in the document
-                word_count = count_words(file_save_path)
-
-                # Define the name of the PDF document to send back
-                response_file_name = "response.pdf"  # Ensure this is the correct file name for the response
-                response_file_path = os.path.join('uploads', response_file_name)
-
-                # Prepare the response message
-                message_text = f"#Submitted\n#Turnitin Intl\nDocument ID: {document_id}\nFile name: {file_name}\nWord count: {word_count}"
-                
-                if os.path.exists(response_file_path):
-                    message_text += "\nFile available ⬇️"
-                else:
-                    message_text += "\nThe document to send back is not available ❌"
-
-                await message.reply(message_text)
-
-                # Send the document back if it exists
-                if os.path.exists(response_file_path):
-                    # Create a temporary file with the document ID in its name
-                    temp_response_file_name = f"{document_id}_response.pdf"
-                    temp_response_file_path = os.path.join('uploads', temp_response_file_name)
-                    
-                    # Copy the response file to the new temporary file path
-                    shutil.copy(response_file_path, temp_response_file_path)
-    
-                    # Open and send the new temporary file
-                    with open(temp_response_file_path, 'rb') as response_file:
-                        await bot.send_document(user_id, response_file, caption=f"Here is the document you requested with ID {document_id}.")
-    
-                    # Clean up the temporary file after sending
-                    os.remove(temp_response_file_path)
-                
-            else:
-                await message.reply("Unsupported file type. Please upload a Word document or PDF.")
-        except Exception as e:
-            logger.error(f"Error handling document: {e}")
-            await message.reply("An error occurred while processing your document. Please try again.")
+    if WORDCOUNT in BOT_FEATURES:
+        user_state = await get_user_state(message.from_user.id)
+        if user_state.get("step") == "ready_for_document":
+            await handle_wordcount_document(message, user_state)
+            return
+
+    if SAVE in BOT_FEATURES or TURNITIN in BOT_FEATURES:
+        await handle_saved_document(message)
     else:
-        await message.reply("You need to follow the correct sequence before uploading a document.")
+        await reply(message, "You need to follow the correct sequence before uploading a document.")
 
 async def on_startup(dp: Dispatcher):
+    global metrics_runner
     logging.info("Starting bot...")
+    logging.info(f"Features: {', '.join(sorted(BOT_FEATURES))}")
+    await state_store.start()
+    document_store.start(STORAGE_SWEEP_INTERVAL)
+    if WATCHDOG_ENABLED:
+        watchdog.start()
+    if WORDCOUNT in BOT_FEATURES:
+        document_workers.start()
+        # Start a worker now so the first document doesn't wait for it and its imports
+        extraction_pool.submit(preload_backends)
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    if turnitin_feature is not None:
+        await turnitin_feature.start()
     
     # Set custom bot commands with descriptions
     commands = [
         {"command": "start", "description": "Start the bot"},
         {"command": "help", "description": "Help on use"}
     ]
+    if WORDCOUNT not in BOT_FEATURES:
+        commands.append({"command": "hello", "description": "Say hello"})
     await bot.set_my_commands([types.BotCommand(command['command'], command['description']) for command in commands])
+    logging.info(f"Ready {process_uptime():.2f}s after process start")
+
+async def on_shutdown(dp: Dispatcher):
+    await document_workers.stop()
+    for task in progress_tasks:
+        task.cancel()
+    await asyncio.gather(*progress_tasks, return_exceptions=True)
+    await outbox.stop()
+    if turnitin_feature is not None:
+        await turnitin_feature.close()
+    await state_store.close()
+    await document_store.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    watchdog.stop()
+    logging.info(f"Job queue: {job_queue.stats()}")
+    logging.info(f"Outbox: {outbox.stats()}")
+    logging.info(f"Word count cache: {word_count_cache.stats()}")
+    logging.info(f"Document store: {document_store.stats()}")
+    if similarity_index is not None:
+        logging.info(f"Similarity index: {similarity_index.stats()}")
+    if WATCHDOG_ENABLED:
+        logging.info(f"Watchdog: {watchdog.stats()}")
+    extraction_pool.shutdown(wait=False, cancel_futures=True)
+
+# Setting WEBHOOK_URL switches from long polling to receiving updates on a webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base URL Telegram sends updates to, e.g. https://example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', '50'))
+
+# Where --profile-startup writes its import time summary
+STARTUP_PROFILE = os.getenv('STARTUP_PROFILE', 'uploads/startup-profile.txt')
+
+# Start the bot; bot2.py, bot2savingdocs.py and bot1turnitin.py call this too
+def main():
+    # Profile the imports of a fresh start instead of running the bot
+    if '--profile-startup' in sys.argv:
+        report = profile_imports('bot', cwd=os.path.dirname(os.path.abspath(__file__)))
+        with open(STARTUP_PROFILE, 'w') as profile:
+            profile.write(report + "\n")
+        print(report)
+        print(f"Written to {STARTUP_PROFILE}")
+        return
+
+    if WEBHOOK_URL:
+        start_webhook(dp, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT,
+                      secret_token=WEBHOOK_SECRET, max_concurrency=WEBHOOK_MAX_CONCURRENCY,
+                      on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
 
-# Start polling
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,152 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+class WordCountCache:
+    """Remembers word counts of documents that have already been counted.
+
+    Entries are keyed by the SHA-256 of the file contents and the counting
+    options (which parts were excluded), and also indexed by Telegram's
+    file_unique_id, so a re-upload of the same file can be answered before
+    it is even downloaded. Each entry also records whether the bibliography
+    was left out, as a document may have none to exclude. The least
+    recently used entries are evicted once there are more than max_entries.
+    """
+
+    def __init__(self, db_path, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(db_path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Entries from before counting options (or the bibliography flag) existed can't be told apart, so start over
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(word_counts)")]
+        if columns and not {'options', 'bibliography_excluded'} <= set(columns):
+            self.db.execute("DROP TABLE word_counts")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS word_counts ("
+            " sha256 TEXT NOT NULL,"
+            " options TEXT NOT NULL,"
+            " file_unique_id TEXT,"
+            " word_count INTEGER NOT NULL,"
+            " bibliography_excluded INTEGER NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (sha256, options))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS word_counts_file ON word_counts (file_unique_id, options)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS word_counts_last_used ON word_counts (last_used)")
+
+    def _lookup(self, column, value, options):
+        row = self.db.execute(f"SELECT sha256, word_count, bibliography_excluded FROM word_counts WHERE {column} = ? AND options = ?",
+                              (value, options)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE word_counts SET last_used = ? WHERE sha256 = ? AND options = ?", (time.time(), row[0], options))
+        return row[1], bool(row[2])
+
+    def get_by_file_id(self, file_unique_id, options=''):
+        """Returns the cached (word count, whether the bibliography was left out) for a Telegram file, or None."""
+        return self._lookup("file_unique_id", file_unique_id, options)
+
+    def get_by_hash(self, sha256, options=''):
+        """Returns the cached (word count, whether the bibliography was left out) for a file with this content hash, or None."""
+        return self._lookup("sha256", sha256, options)
+
+    def put(self, sha256, file_unique_id, word_count, options='', bibliography_excluded=False):
+        self.db.execute(
+            "INSERT OR REPLACE INTO word_counts (sha256, options, file_unique_id, word_count, bibliography_excluded, last_used)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (sha256, options, file_unique_id, word_count, bibliography_excluded, time.time()),
+        )
+        self.db.execute(
+            "DELETE FROM word_counts WHERE rowid IN ("
+            " SELECT rowid FROM word_counts ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+class FileIdCache:
+    """Remembers the Telegram file_id of files the bot has uploaded, so they can be resent without uploading them again.
+
+    An entry is used while the file's size and modification time are
+    unchanged. If they change, the file is hashed again and the entry only
+    survives if the contents are still the same.
+    """
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            " path TEXT PRIMARY KEY,"
+            " mtime_ns INTEGER NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " sha256 TEXT NOT NULL,"
+            " file_id TEXT NOT NULL)"
+        )
+
+    @staticmethod
+    def _hash(path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def get(self, path):
+        """Returns the file_id of an earlier upload of this file, or None if it has to be uploaded."""
+        row = self.db.execute("SELECT mtime_ns, size, sha256, file_id FROM file_ids WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        mtime_ns, size, sha256, file_id = row
+        stat = os.stat(path)
+        if (stat.st_mtime_ns, stat.st_size) == (mtime_ns, size):
+            return file_id
+        if stat.st_size != size or self._hash(path) != sha256:
+            self.forget(path)
+            return None
+        # Touched but not changed
+        self.db.execute("UPDATE file_ids SET mtime_ns = ? WHERE path = ?", (stat.st_mtime_ns, path))
+        return file_id
+
+    def put(self, path, file_id):
+        stat = os.stat(path)
+        self.db.execute(
+            "INSERT OR REPLACE INTO file_ids (path, mtime_ns, size, sha256, file_id) VALUES (?, ?, ?, ?, ?)",
+            (path, stat.st_mtime_ns, stat.st_size, self._hash(path), file_id),
+        )
+
+    def forget(self, path):
+        self.db.execute("DELETE FROM file_ids WHERE path = ?", (path,))
+
+class ReportCache:
+    """Remembers the Turnitin report of every checked document, so a near-duplicate can be answered with it."""
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS turnitin_reports ("
+            " document_id INTEGER PRIMARY KEY,"
+            " report_url TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+
+    def get(self, document_id):
+        """Returns the report URL of a document whose check completed, or None."""
+        row = self.db.execute("SELECT report_url FROM turnitin_reports WHERE document_id = ?", (document_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, document_id, report_url):
+        self.db.execute("INSERT OR REPLACE INTO turnitin_reports (document_id, report_url, created_at) VALUES (?, ?, ?)",
+                        (document_id, report_url, time.time()))
@@ -0,0 +1,83 @@
+ANY_STEP = '*'
+
+def normalize(text):
+    """Normalizes message text once per update so transitions can be looked up directly."""
+    return text.strip().lower()
+
+class Conversation:
+    """Table-driven conversation flow: (step, normalized text) -> handler.
+
+    Handlers are registered with the on() decorator for one or more steps
+    and inputs. A transition registered for ANY_STEP applies when the
+    user's current step has no transition of its own for that input.
+    Dispatch is a dictionary lookup, however many transitions there are,
+    and doesn't involve Telegram, so flows can be tested with plain values.
+    """
+
+    def __init__(self):
+        self.transitions = {}
+        self.inputs = set()
+
+    def on(self, steps, *texts):
+        if isinstance(steps, str):
+            steps = [steps]
+
+        def register(handler):
+            for step in steps:
+                for text in texts:
+                    self.transitions[(step, normalize(text))] = handler
+                    self.inputs.add(normalize(text))
+            return handler
+
+        return register
+
+    def handles(self, text):
+        """Returns whether any transition accepts this (normalized) input."""
+        return text in self.inputs
+
+    def resolve(self, step, text):
+        """Returns the handler for a (normalized) input at the given step, or None."""
+        handler = self.transitions.get((step, text))
+        if handler is None:
+            handler = self.transitions.get((ANY_STEP, text))
+        return handler
+
+# Dispatch micro-benchmark: python conversation.py
+if __name__ == "__main__":
+    import timeit
+
+    def handler(*args):
+        pass
+
+    def build(inputs):
+        """Returns a transition table and the equivalent filter chain for a flow with these inputs."""
+        conversation = Conversation()
+        for number, text in enumerate(inputs):
+            conversation.on(f"step_{number}", text)(handler)
+            conversation.on(ANY_STEP, text)(handler)
+        # Every filter in the chain lowercases the text again
+        filters = [lambda message_text, text=text.lower(): message_text.lower() == text for text in inputs]
+        return conversation, filters
+
+    def dispatch_chain(filters, text):
+        for check in filters:
+            if check(text):
+                return check
+        return None
+
+    def dispatch_table(conversation, text, step):
+        text = normalize(text)
+        if conversation.handles(text):
+            return conversation.resolve(step, text)
+        return None
+
+    number = 100000
+    for size in (3, 30):
+        inputs = ["\U0001F30D Turnitin Intl", "yes", "no"] + [f"option {n}" for n in range(size - 3)]
+        conversation, filters = build(inputs)
+        # The last input and unmatched text are the worst case for the chain
+        updates = [(inputs[-1].upper(), f"step_{size - 1}"), ("hello there", None), ("YES", "step_1")]
+        chain = timeit.timeit(lambda: [dispatch_chain(filters, text) for text, _ in updates], number=number)
+        table = timeit.timeit(lambda: [dispatch_table(conversation, text, step) for text, step in updates], number=number)
+        per_update = number * len(updates)
+        print(f"{size:>3} inputs: filter chain {chain / per_update * 1e9:.0f} ns, transition table {table / per_update * 1e9:.0f} ns per update")
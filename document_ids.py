@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import threading
+
+class DocumentIdAllocator:
+    """Hands out unique document IDs from a SQLite database shared by all bot processes.
+
+    Each process reserves IDs in blocks of block_size inside an IMMEDIATE
+    transaction, so most calls never touch the database. A process that
+    crashes loses the rest of its block, but an ID is never handed out twice.
+    """
+
+    def __init__(self, db_path, block_size=10, start_after=0):
+        self.db_path = db_path
+        self.block_size = block_size
+        self.start_after = start_after
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.db = None
+        self.next_id = 0
+        self.block_end = 0  # First ID past the reserved block
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.execute("CREATE TABLE IF NOT EXISTS document_ids (id INTEGER PRIMARY KEY CHECK (id = 0), last_id INTEGER NOT NULL)")
+        db.execute("INSERT OR IGNORE INTO document_ids (id, last_id) VALUES (0, ?)", (self.start_after,))
+        return db
+
+    def _reserve_block(self):
+        if self.db is None:
+            self.db = self._connect()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            (last_id,) = self.db.execute("SELECT last_id FROM document_ids WHERE id = 0").fetchone()
+            self.db.execute("UPDATE document_ids SET last_id = ? WHERE id = 0", (last_id + self.block_size,))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.next_id = last_id + 1
+        self.block_end = last_id + self.block_size + 1
+
+    def allocate(self):
+        """Returns a new document ID."""
+        with self.lock:
+            # A forked child must not keep handing out its parent's block
+            if self.pid != os.getpid():
+                self._reset()
+            if self.next_id >= self.block_end:
+                self._reserve_block()
+            document_id = self.next_id
+            self.next_id += 1
+            return document_id
+
+def read_legacy_counter(counter_file):
+    """Returns the last ID stored in the old counter.txt file, or 0."""
+    try:
+        with open(counter_file, 'r') as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+# Stress test: python document_ids.py [processes] [ids per process]
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import time
+    from multiprocessing import Pool
+
+    def allocate_many(args):
+        db_path, count = args
+        allocator = DocumentIdAllocator(db_path)
+        return [allocator.allocate() for _ in range(count)]
+
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    per_process = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'ids.db')
+        started = time.perf_counter()
+        with Pool(processes) as pool:
+            results = pool.map(allocate_many, [(db_path, per_process)] * processes)
+        elapsed = time.perf_counter() - started
+
+    ids = [document_id for result in results for document_id in result]
+    assert len(ids) == len(set(ids)), "duplicate document IDs"
+    assert all(result == sorted(result) for result in results), "IDs went backwards within a process"
+    print(f"{len(ids)} unique IDs from {processes} processes in {elapsed:.2f}s ({len(ids) / elapsed:,.0f} IDs/s)")
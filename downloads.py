@@ -0,0 +1,105 @@
+import hashlib
+import io
+import os
+import tempfile
+
+class HashingWriter(io.RawIOBase):
+    """Write-only file wrapper that hashes and counts everything written through it."""
+
+    def __init__(self, file):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        # aiogram flushes after every chunk; let the buffered file decide when to hit the disk
+        pass
+
+async def download_to_file(bot, file_path, dest_path, chunk_size=65536):
+    """Streams a Telegram file straight to dest_path and returns (sha256 hex digest, size).
+
+    Chunks are written to a temporary file next to dest_path which is
+    renamed into place once the download is complete, so a failed download
+    never leaves a partial file behind.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path) or '.', prefix='.download-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            writer = HashingWriter(temp_file)
+            await bot.download_file(file_path, destination=writer, chunk_size=chunk_size, seek=False)
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return writer.sha256.hexdigest(), writer.size
+
+# Memory benchmark: python downloads.py [size in MB]
+if __name__ == "__main__":
+    import asyncio
+    import sys
+    import time
+    import tracemalloc
+    from aiohttp import web
+    from aiogram import Bot
+    from aiogram.bot.api import TelegramAPIServer
+
+    TOKEN = "123456:benchmark"
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 20 * 1024 * 1024
+    payload = os.urandom(size)
+
+    async def serve_file(request):
+        # Stream the payload too, so the server side doesn't dominate the measurement
+        response = web.StreamResponse(headers={'Content-Length': str(size)})
+        await response.prepare(request)
+        view = memoryview(payload)
+        for offset in range(0, size, 65536):
+            await response.write(view[offset:offset + 65536])
+        await response.write_eof()
+        return response
+
+    async def measure(name, download):
+        tracemalloc.start()
+        started = time.perf_counter()
+        await download()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:<10} {elapsed:.3f}s, peak Python memory {peak / 1024 / 1024:.1f} MB")
+
+    async def main():
+        app = web.Application()
+        app.router.add_get(f"/file/bot{TOKEN}/{{path:.*}}", serve_file)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        bot = Bot(TOKEN, server=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}"))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            dest_path = os.path.join(tmp, 'document.pdf')
+
+            async def buffered():
+                downloaded_file = await bot.download_file('documents/file.pdf')
+                with open(dest_path, 'wb') as new_file:
+                    new_file.write(downloaded_file.getvalue())
+
+            async def streamed():
+                await download_to_file(bot, 'documents/file.pdf', dest_path)
+
+            print(f"Downloading {size / 1024 / 1024:.0f} MB")
+            await measure("buffered", buffered)
+            await measure("streamed", streamed)
+
+        await (await bot.get_session()).close()
+        await runner.cleanup()
+
+    asyncio.run(main())
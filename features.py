@@ -0,0 +1,73 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The bots that used to run as separate scripts are now features of one bot
+WORDCOUNT = "wordcount"  # Region/bibliography/quotes flow followed by a word count (bot.py, bot2.py)
+SAVE = "save"  # Save uploaded documents (bot2savingdocs.py)
+TURNITIN = "turnitin"  # Save uploaded Word documents and check them with Turnitin (bot1turnitin.py)
+ALL_FEATURES = (WORDCOUNT, SAVE, TURNITIN)
+
+WORD_MIME_TYPES = ['application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']
+DOCUMENT_MIME_TYPES = WORD_MIME_TYPES + ['application/pdf']
+
+def parse_features(value):
+    """Turns a comma separated BOT_FEATURES value into a set of feature names."""
+    features = {name.strip().lower() for name in value.split(',') if name.strip()}
+    unknown = features - set(ALL_FEATURES)
+    if unknown:
+        raise ValueError(f"Unknown BOT_FEATURES: {', '.join(sorted(unknown))}. Choose from {', '.join(ALL_FEATURES)}.")
+    if not features:
+        raise ValueError(f"BOT_FEATURES is empty. Choose from {', '.join(ALL_FEATURES)}.")
+    return features
+
+class TurnitinFeature:
+    """Checks saved documents with Turnitin and replies with the report once it's ready.
+
+    The Turnitin client reuses the bot's HTTP session, so both talk
+    through one connection pool on the bot's event loop. Completed reports
+    are recorded in reports (a ReportCache), if given.
+    """
+
+    def __init__(self, bot, api_url, api_key, max_concurrent=5, reply=None, reports=None):
+        if api_key is None or api_url is None:
+            raise ValueError("Turnitin API credentials are not defined. Please set TURNITIN_API_KEY and TURNITIN_API_URL in your .env file.")
+        self.bot = bot
+        self.api_url = api_url
+        self.api_key = api_key
+        self.max_concurrent = max_concurrent
+        self.reply = reply or (lambda message, text: message.reply(text))  # Coroutine function sending a reply
+        self.reports = reports
+        self.client = None
+        self.tasks = set()
+
+    async def start(self):
+        # Only pull in the Turnitin client when the feature is switched on
+        from turnitin import TurnitinClient
+        session = await self.bot.get_session()
+        self.client = TurnitinClient(self.api_url, self.api_key, session=session, max_concurrent=self.max_concurrent)
+
+    def check(self, message, file_path, document_id=None):
+        """Starts a check in the background; the report is sent as a reply to message."""
+        task = asyncio.create_task(self._check(message, file_path, document_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _check(self, message, file_path, document_id):
+        try:
+            report_url = await self.client.check(file_path)
+        except Exception as e:
+            logger.warning(f"Turnitin check of {file_path} failed: {e}")
+            await self.reply(message, f"Failed to check the document: {str(e)}")
+        else:
+            if self.reports is not None and document_id is not None:
+                self.reports.put(document_id, report_url)
+            await self.reply(message, f"Turnitin Report URL: {report_url}")
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.client is not None:
+            await self.client.close()
@@ -0,0 +1,242 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+
+from metrics import JOB_SECONDS, JOB_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+Job = namedtuple('Job', ['id', 'kind', 'payload', 'attempts', 'created_at'])
+
+class PermanentJobError(Exception):
+    """Raised by a job handler for a failure that trying again can't fix, so the job fails straight away."""
+
+class RetryLater(Exception):
+    """Raised by a job handler that can't run the job yet, e.g. because a resource is busy.
+
+    The job goes back in the queue for delay seconds without using up an attempt.
+    """
+
+    def __init__(self, delay=5):
+        super().__init__(f"retry in {delay} seconds")
+        self.delay = delay
+
+class JobQueue:
+    """Durable job queue in a SQLite database, shared by every bot process using the same file.
+
+    A claimed job is leased for lease_time seconds, and its worker renews
+    the lease for as long as the job runs. If the worker dies the lease
+    runs out and another worker picks it up again. Failed jobs are
+    retried up to max_attempts times with an increasing delay, unless they
+    raise PermanentJobError. A job raising RetryLater is postponed without
+    counting the attempt. The payload is saved whenever the lease is
+    renewed, the job fails, or it is postponed or released, so a handler
+    can record its progress in it and a retry carries on where the
+    previous attempt stopped.
+    """
+
+    def __init__(self, db_path, max_attempts=3, retry_delay=10, lease_time=600):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_time = lease_time
+        self.local = threading.local()
+        self.latencies = deque(maxlen=1000)  # Seconds from enqueue to completion of recent jobs
+        self.completed = 0
+        self.retried = 0
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " kind TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'queued',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " available_at REAL NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " error TEXT)"
+        )
+        self._connect().execute("CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, available_at)")
+
+    def _connect(self):
+        # One connection per thread so the queue can be shared with threads (e.g. run_in_executor)
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def enqueue(self, kind, payload):
+        """Adds a job and returns its ID."""
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO jobs (kind, payload, available_at, created_at) VALUES (?, ?, ?, ?)",
+            (kind, json.dumps(payload), now, now),
+        )
+        return cursor.lastrowid
+
+    def claim(self):
+        """Leases the oldest job that is ready to run, or returns None if there is none."""
+        db = self._connect()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT id, kind, payload, attempts, created_at FROM jobs"
+                " WHERE status IN ('queued', 'running') AND available_at <= ? ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, available_at = ? WHERE id = ?",
+                           (now + self.lease_time, row[0]))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return Job(row[0], row[1], json.loads(row[2]), row[3] + 1, row[4])
+
+    def renew(self, job):
+        """Extends the lease of a running job, so it isn't picked up again while it is still going."""
+        self._connect().execute("UPDATE jobs SET available_at = ?, payload = ? WHERE id = ? AND status = 'running'",
+                                (time.time() + self.lease_time, json.dumps(job.payload), job.id))
+
+    def complete(self, job):
+        self._connect().execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+        self.completed += 1
+        self.latencies.append(time.time() - job.created_at)
+
+    def fail(self, job, error, retry=True):
+        """Schedules a failed job for another attempt. Returns False once it has run out of attempts, or if retry is False."""
+        if not retry or job.attempts >= self.max_attempts:
+            self._connect().execute("UPDATE jobs SET status = 'failed', error = ?, payload = ? WHERE id = ?",
+                                    (str(error), json.dumps(job.payload), job.id))
+            return False
+        self._connect().execute(
+            "UPDATE jobs SET status = 'queued', available_at = ?, error = ?, payload = ? WHERE id = ?",
+            (time.time() + self.retry_delay * job.attempts, str(error), json.dumps(job.payload), job.id),
+        )
+        self.retried += 1
+        return True
+
+    def release(self, job):
+        """Puts a job back in the queue without counting the interrupted attempt."""
+        self._connect().execute(
+            "UPDATE jobs SET status = 'queued', attempts = attempts - 1, available_at = ?, payload = ? WHERE id = ?",
+            (time.time(), json.dumps(job.payload), job.id),
+        )
+
+    def postpone(self, job, delay):
+        """Puts a job back in the queue to run again after delay seconds, without counting this attempt."""
+        self._connect().execute(
+            "UPDATE jobs SET status = 'queued', attempts = attempts - 1, available_at = ?, payload = ? WHERE id = ?",
+            (time.time() + delay, json.dumps(job.payload), job.id),
+        )
+
+    def position(self, job_id):
+        """Returns how many jobs are waiting ahead of a job."""
+        (ahead,) = self._connect().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND id < ?", (job_id,)).fetchone()
+        return ahead
+
+    def depth(self):
+        """Returns the number of jobs waiting to run."""
+        (queued,) = self._connect().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()
+        return queued
+
+    def stats(self):
+        counts = dict(self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        latencies = sorted(self.latencies)
+        return {
+            "queued": counts.get('queued', 0),
+            "running": counts.get('running', 0),
+            "failed": counts.get('failed', 0),
+            "completed": self.completed,
+            "retried": self.retried,
+            "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "latency_p99": latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+        }
+
+async def _renew_lease(queue, job):
+    while True:
+        await asyncio.sleep(queue.lease_time / 3)
+        queue.renew(job)
+
+async def _run_job(queue, job, handlers, on_failure):
+    if job.attempts == 1:
+        JOB_WAIT_SECONDS.labels(job.kind).observe(max(time.time() - job.created_at, 0.0))
+    started = time.perf_counter()
+    outcome = 'cancelled'
+    renewal = asyncio.create_task(_renew_lease(queue, job))
+    try:
+        await handlers[job.kind](job.payload)
+    except asyncio.CancelledError:
+        # Shutting down: let the next worker start this job again straight away
+        queue.release(job)
+        raise
+    except RetryLater as e:
+        outcome = 'postponed'
+        logger.info(f"Job {job.id} ({job.kind}) postponed for {e.delay} seconds")
+        queue.postpone(job, e.delay)
+    except PermanentJobError as e:
+        outcome = 'failed'
+        logger.warning(f"Job {job.id} ({job.kind}) failed permanently: {e}")
+        queue.fail(job, e, retry=False)
+        if on_failure is not None:
+            await on_failure(job, e)
+    except Exception as e:
+        logger.exception(f"Job {job.id} ({job.kind}) failed on attempt {job.attempts}")
+        retrying = queue.fail(job, e)
+        outcome = 'retried' if retrying else 'failed'
+        if not retrying and on_failure is not None:
+            await on_failure(job, e)
+    else:
+        outcome = 'completed'
+        queue.complete(job)
+    finally:
+        renewal.cancel()
+        JOB_SECONDS.labels(job.kind, outcome).observe(time.perf_counter() - started)
+
+class AsyncWorkers:
+    """Runs jobs from a JobQueue with a pool of asyncio workers.
+
+    handlers maps a job kind to a coroutine function taking the payload,
+    which it may update to record its progress. on_failure(job, error) is
+    awaited once a job has used up its attempts or failed permanently.
+    """
+
+    def __init__(self, queue, handlers, workers=4, poll_interval=0.5, on_failure=None):
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.on_failure = on_failure
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+
+    def notify(self):
+        """Wakes an idle worker straight away instead of at its next poll."""
+        self.wakeup.set()
+
+    async def _work(self):
+        while True:
+            job = self.queue.claim()
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await _run_job(self.queue, job, self.handlers, self.on_failure)
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,368 @@
+"""Replays Telegram updates against a local webhook server and reports handler latency.
+
+    python loadtest.py [updates.jsonl] [--users N] [--documents] [--sizes small,medium,large]
+                       [--concurrency N] [--save-updates PATH] [--workdir DIR]
+
+Updates are read from a JSON-lines file (one recorded Update per line) or,
+without a file, generated for --users users walking through the
+/start -> region -> bibliography -> quotes flow. With --documents every
+user then uploads a generated PDF or Word document of one of the --sizes,
+which the fake server hands out through getFile and its file download
+URL, and the document is timed until its word count report arrives.
+
+Bot API calls made by the handlers are answered by a fake Bot API server,
+so nothing reaches Telegram. Updates from the same chat are replayed in
+order, each one after the previous has been handled; different chats run
+concurrently. The bot runs in a fresh --workdir (a temporary directory by
+default), so caches left by earlier runs don't flatter the numbers.
+
+Reports throughput, handler and document latency, event loop lag and
+the peak RSS of the bot and its extraction workers.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+from collections import defaultdict
+
+from aiohttp import ClientSession, web
+
+TOKEN = "123456:loadtest"
+SECRET = "loadtest-secret"
+
+def fake_result(method, data):
+    """Returns a plausible Bot API result for method."""
+    chat_id = int(data.get('chat_id', 0) or 0)
+    if method in ('sendMessage', 'editMessageText'):
+        return {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": data.get('text', '')}
+    if method == 'sendDocument':
+        return {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                "document": {"file_id": "fake-file-id", "file_unique_id": "fake-file"}}
+    if method == 'getMe':
+        return {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+    return True
+
+# Messages that end the handling of a document, one way or another
+FINAL_REPLIES = ("#Submitted", "An error occurred", "Your document took too long", "Unsupported file type",
+                 "You need to follow", "The archive")
+
+class FakeBotAPI:
+    """Minimal stand-in for api.telegram.org that counts the calls it receives.
+
+    Files registered with add_file() can be fetched with getFile and
+    downloaded like from Telegram's file server, and the last reply that
+    finished a document is signalled to waiters per chat.
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.files = {}  # file_id -> path on disk
+        self.final_replies = defaultdict(asyncio.Event)  # chat_id -> set when a document is answered
+
+    def add_file(self, file_id, path):
+        self.files[file_id] = path
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        data = await request.post()
+        if method == 'getFile':
+            path = self.files.get(data.get('file_id'))
+            if path is None:
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"},
+                                         status=400)
+            return web.json_response({"ok": True, "result": {
+                "file_id": data['file_id'], "file_unique_id": data['file_id'], "file_size": os.path.getsize(path),
+                "file_path": f"documents/{data['file_id']}"}})
+        if method == 'sendMessage' and data.get('text', '').startswith(FINAL_REPLIES):
+            self.final_replies[int(data['chat_id'])].set()
+        return web.json_response({"ok": True, "result": fake_result(method, data)})
+
+    async def download(self, request):
+        path = self.files.get(request.match_info['file_id'])
+        if path is None:
+            raise web.HTTPNotFound()
+        return web.FileResponse(path)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(f"/bot{TOKEN}/{{method}}", self.handle)
+        app.router.add_get(f"/file/bot{TOKEN}/documents/{{file_id}}", self.download)
+        return app
+
+def text_update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+        },
+    }
+
+def document_update(update_id, user_id, file_id, file_name, mime_type):
+    update = text_update(update_id, user_id, None)
+    del update["message"]["text"]
+    update["message"]["document"] = {"file_id": file_id, "file_unique_id": file_id, "file_name": file_name, "mime_type": mime_type}
+    return update
+
+# Pages of text in the generated documents of each size
+DOCUMENT_SIZES = {'small': 2, 'medium': 20, 'large': 200}
+DOCUMENT_TYPES = {'pdf': 'application/pdf',
+                  'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'}
+LINES_PER_PAGE = 40
+# file_ids of generated documents say what to generate, so a saved stream can be replayed
+GENERATED_FILE_ID = re.compile(r'^loadtest-(\d+)-(\w+)\.(pdf|docx)$')
+VOCABULARY = ("essay student analysis research argument evidence conclusion theory method result discussion "
+              "literature source claim data sample study author paper review context finding").split()
+
+def synthetic_updates(users, documents=False, sizes=('small', 'medium')):
+    flow = ["/start", "\U0001F30D Turnitin Intl", "YES", "NO"]
+    updates = []
+    for user_id in range(1, users + 1):
+        for text in flow:
+            updates.append(text_update(len(updates) + 1, user_id, text))
+        if documents:
+            # Alternate PDFs and Word documents, and cycle through the sizes
+            extension = ('pdf', 'docx')[user_id % 2]
+            size = sizes[(user_id // 2) % len(sizes)]
+            file_id = f"loadtest-{user_id}-{size}.{extension}"
+            updates.append(document_update(len(updates) + 1, user_id, file_id, f"essay-{user_id}.{extension}",
+                                           DOCUMENT_TYPES[extension]))
+    return updates
+
+def document_lines(seed, pages):
+    """Returns pages of random sentences; every seed gives different text so no two uploads share a cached count."""
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(VOCABULARY, k=12)) + "." for _ in range(pages * LINES_PER_PAGE)]
+
+def make_pdf(path, lines):
+    """Writes a bare-bones PDF by hand, so PyMuPDF isn't loaded into the process being measured."""
+    pages = [lines[start:start + LINES_PER_PAGE] for start in range(0, len(lines), LINES_PER_PAGE)]
+    page_numbers = [4 + 2 * index for index in range(len(pages))]  # Each page is followed by its content stream
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{number} 0 R' for number in page_numbers)}] /Count {len(pages)} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for number, page_lines in zip(page_numbers, pages):
+        content = "BT /F1 10 Tf 18 TL 50 780 Td " + " ".join(f"({line}) '" for line in page_lines) + " ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >>"
+                       f" /Contents {number + 1} 0 R >>".encode())
+        objects.append(f"<< /Length {len(content)} >>\nstream\n{content}\nendstream".encode())
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, 'wb') as f:
+        f.write(pdf)
+
+def make_docx(path, lines):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml',
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="xml" ContentType="application/xml"/></Types>')
+        body = "".join(f'<w:p><w:r><w:t>{line}</w:t></w:r></w:p>' for line in lines)
+        archive.writestr('word/document.xml',
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f'<w:body>{body}</w:body></w:document>')
+
+def generate_documents(updates, directory, fake_api):
+    """Writes the generated documents the updates refer to and registers them with the fake API."""
+    os.makedirs(directory, exist_ok=True)
+    for update in updates:
+        document = update.get('message', {}).get('document')
+        match = GENERATED_FILE_ID.match(document['file_id']) if document else None
+        if match is None:
+            continue
+        seed, size, extension = match.groups()
+        path = os.path.join(directory, document['file_id'])
+        if not os.path.exists(path):
+            lines = document_lines(int(seed), DOCUMENT_SIZES[size])
+            (make_pdf if extension == 'pdf' else make_docx)(path, lines)
+        fake_api.add_file(document['file_id'], path)
+
+def load_updates(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def chat_id_of(update):
+    for kind in ('message', 'edited_message', 'callback_query'):
+        if kind in update:
+            item = update[kind]
+            return (item.get('chat') or item.get('message', {}).get('chat') or item.get('from'))['id']
+    return None
+
+async def start_site(app):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from short sleeps, i.e. how long something blocked it."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - started - self.interval))
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+async def replay(updates, concurrency, document_timeout=300):
+    fake_api = FakeBotAPI()
+    generate_documents(updates, os.path.join(os.getcwd(), 'loadtest-documents'), fake_api)
+    api_runner, api_port = await start_site(fake_api.make_app())
+
+    # bot.py reads its configuration at import time
+    os.environ['BOT_TOKEN'] = TOKEN
+    os.environ['TELEGRAM_API_SERVER'] = f"http://127.0.0.1:{api_port}"
+    # Measure the handlers rather than the rate limits, unless limits are set explicitly
+    for name in ('THROTTLE_USER_RATE', 'THROTTLE_USER_BURST', 'THROTTLE_GLOBAL_RATE', 'THROTTLE_GLOBAL_BURST',
+                 'OUTBOX_CHAT_RATE', 'OUTBOX_CHAT_BURST', 'OUTBOX_GLOBAL_RATE', 'OUTBOX_GLOBAL_BURST'):
+        os.environ.setdefault(name, '1000000')
+    import bot
+    from webhook import WebhookServer
+
+    latencies = []
+    document_latencies = []
+    document_failures = 0
+    handled = {}
+
+    def on_processed(update, seconds):
+        latencies.append(seconds)
+        handled.pop(update.update_id).set()
+
+    server = WebhookServer(bot.dp, secret_token=SECRET, max_concurrency=concurrency, on_processed=on_processed)
+    webhook_runner, webhook_port = await start_site(server.make_app('/webhook'))
+    await bot.on_startup(bot.dp)
+    lag_monitor = LoopLagMonitor()
+    lag_monitor.start()
+
+    by_chat = defaultdict(list)
+    for update in updates:
+        by_chat[chat_id_of(update)].append(update)
+
+    async with ClientSession() as session:
+        async def replay_chat(chat_updates):
+            nonlocal document_failures
+            for update in chat_updates:
+                done = handled[update['update_id']] = asyncio.Event()
+                is_document = 'document' in update.get('message', {})
+                if is_document:
+                    answered = fake_api.final_replies[chat_id_of(update)]
+                    answered.clear()
+                sent = time.perf_counter()
+                async with session.post(f"http://127.0.0.1:{webhook_port}/webhook", json=update,
+                                        headers={'X-Telegram-Bot-Api-Secret-Token': SECRET}) as response:
+                    response.raise_for_status()
+                await done.wait()
+                if is_document:
+                    # The handler only queues the document; it's done when the report goes out
+                    try:
+                        await asyncio.wait_for(answered.wait(), document_timeout)
+                        document_latencies.append(time.perf_counter() - sent)
+                    except asyncio.TimeoutError:
+                        document_failures += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(replay_chat(chat_updates) for chat_updates in by_chat.values()))
+        elapsed = time.perf_counter() - started
+
+    await lag_monitor.stop()
+    await server.drain()
+    # on_shutdown doesn't wait for the extraction workers, but they must have exited for their peak RSS to be counted
+    await bot.document_workers.stop()
+    await asyncio.to_thread(bot.extraction_pool.shutdown, wait=True, cancel_futures=True)
+    await bot.on_shutdown(bot.dp)
+    await (await bot.bot.get_session()).close()
+    await webhook_runner.cleanup()
+    await api_runner.cleanup()
+
+    print(f"{len(latencies)} updates from {len(by_chat)} chats in {elapsed:.2f}s ({len(latencies) / elapsed:,.0f} updates/s)")
+    print(f"handler latency p50 {percentile(latencies, 0.50) * 1000:.1f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms, "
+          f"mean {statistics.mean(latencies) * 1000:.1f} ms")
+    if document_latencies or document_failures:
+        print(f"{len(document_latencies)} documents reported ({len(document_latencies) / elapsed:.1f}/s), "
+              f"{document_failures} timed out", end='')
+        if document_latencies:
+            print(f"; upload to report p50 {percentile(document_latencies, 0.50):.2f}s, "
+                  f"p99 {percentile(document_latencies, 0.99):.2f}s", end='')
+        print()
+    lags = lag_monitor.lags or [0.0]
+    print(f"event loop lag p50 {percentile(lags, 0.50) * 1000:.1f} ms, p99 {percentile(lags, 0.99) * 1000:.1f} ms, "
+          f"max {max(lags) * 1000:.1f} ms")
+    print(f"peak RSS: bot {peak_rss_mb():.0f} MB, largest extraction worker {peak_rss_mb(resource.RUSAGE_CHILDREN):.0f} MB")
+    print("Bot API calls: " + ", ".join(f"{method}={count}" for method, count in sorted(fake_api.calls.items())))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay Telegram updates against a local webhook server.")
+    parser.add_argument('updates', nargs='?', help="JSON-lines file of recorded updates")
+    parser.add_argument('--users', type=int, default=200, help="number of synthetic users when no file is given")
+    parser.add_argument('--documents', action='store_true', help="have every synthetic user upload a document")
+    parser.add_argument('--sizes', default='small,medium',
+                        help=f"comma separated sizes of the generated documents, from {', '.join(DOCUMENT_SIZES)}")
+    parser.add_argument('--concurrency', type=int, default=50, help="maximum updates handled at once")
+    parser.add_argument('--document-timeout', type=float, default=300, help="seconds to wait for each document's report")
+    parser.add_argument('--save-updates', help="write the updates to this JSON-lines file so the run can be replayed")
+    parser.add_argument('--workdir', help="directory the bot keeps its uploads and databases in (default: a new temporary one)")
+    args = parser.parse_args()
+
+    sizes = [size.strip() for size in args.sizes.split(',')]
+    unknown = set(sizes) - set(DOCUMENT_SIZES)
+    if unknown:
+        parser.error(f"unknown sizes: {', '.join(sorted(unknown))}")
+    updates = load_updates(args.updates) if args.updates else synthetic_updates(args.users, args.documents, sizes)
+    if args.save_updates:
+        with open(args.save_updates, 'w') as f:
+            f.writelines(json.dumps(update) + "\n" for update in updates)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='loadtest-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    print(f"Working in {workdir}")
+    try:
+        asyncio.run(replay(updates, args.concurrency, args.document_timeout))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from metrics import EVENT_LOOP_LAG, LOOP_STALLS, SLOW_HANDLERS
+
+logger = logging.getLogger(__name__)
+
+def collapse_stack(frame):
+    """Returns a frame's stack in collapsed-stack format, outermost call first, as flamegraph.pl and speedscope read it."""
+    calls = []
+    while frame is not None:
+        code = frame.f_code
+        calls.append(f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(calls))
+
+class Stall:
+    """One stretch of time the event loop was blocked, with the stacks sampled during it."""
+
+    def __init__(self, started, label):
+        self.started = started
+        self.label = label
+        self.samples = Counter()
+        self.path = None
+
+class LoopWatchdog:
+    """Notices when something blocks the event loop, and records what it was doing.
+
+    A callback on the loop beats every sample_interval seconds and records
+    how late it ran as the event loop lag. A sampler thread checks the
+    last beat on the same interval; as soon as a beat is missed, it
+    samples the loop thread's stack until the loop runs again, so the
+    whole stall is profiled. Stalls longer than budget seconds are
+    written in collapsed-stack format to output_dir, named after the
+    update that was being handled, keeping the newest max_files dumps.
+    While the loop is healthy the thread only compares two timestamps,
+    so it can be left on in production.
+    """
+
+    def __init__(self, budget=0.1, sample_interval=0.01, output_dir='uploads/watchdog', max_files=100):
+        self.budget = budget
+        self.sample_interval = sample_interval
+        self.output_dir = output_dir
+        self.max_files = max_files
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+        self.handle = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.labels = {}  # Task -> what it is doing, e.g. the update being handled
+        self.stall = None  # The stall in progress, or None
+        self.stalls = 0
+
+    def start(self):
+        """Starts watching the running event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.handle = self.loop.call_later(self.sample_interval, self._beat)
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._sample, name='loop-watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def _beat(self):
+        now = time.monotonic()
+        EVENT_LOOP_LAG.observe(max(0.0, now - self.last_beat - self.sample_interval))
+        self.last_beat = now
+        self.handle = self.loop.call_later(self.sample_interval, self._beat)
+
+    def track(self, label, task=None):
+        """Names what a task is doing, so a stall while it runs is attributed to it."""
+        self.labels[task or asyncio.current_task()] = label
+
+    def untrack(self, task=None):
+        return self.labels.pop(task or asyncio.current_task(), None)
+
+    def _running_label(self):
+        # Called from the sampler thread; the loop is blocked, so the task it is running is the culprit
+        task = asyncio.current_task(self.loop)
+        if task is None:
+            return "callback"
+        label = self.labels.get(task)
+        return label if label is not None else task.get_name()
+
+    def _sample(self):
+        while not self.stopping.wait(self.sample_interval):
+            blocked_for = time.monotonic() - self.last_beat - self.sample_interval
+            if blocked_for > self.sample_interval:
+                # A beat is overdue; sample in case this turns out to be a stall
+                if self.stall is None:
+                    self.stall = Stall(self.last_beat + self.sample_interval, self._running_label())
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    self.stall.samples[collapse_stack(frame)] += 1
+            elif self.stall is not None:
+                if self.last_beat - self.stall.started > self.budget:
+                    self._finish(self.stall)
+                self.stall = None
+
+    def _finish(self, stall):
+        duration = self.last_beat - stall.started
+        self.stalls += 1
+        LOOP_STALLS.inc()
+        name = re.sub(r'[^\w.-]+', '_', stall.label)[:80]
+        stall.path = os.path.join(self.output_dir, f"stall-{time.strftime('%Y%m%d-%H%M%S')}-{duration * 1000:.0f}ms-{name}.folded")
+        try:
+            with open(stall.path, 'w') as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in stall.samples.most_common())
+            self._prune()
+        except OSError as e:
+            logger.warning(f"Could not write the stall profile: {e}")
+        top = stall.samples.most_common(1)[0][0].rsplit(";", 1)[-1] if stall.samples else "unknown"
+        logger.warning(f"Event loop blocked for {duration * 1000:.0f} ms by {stall.label}, mostly in {top}; "
+                       f"{sum(stall.samples.values())} samples in {stall.path}")
+
+    def _prune(self):
+        dumps = sorted((entry for entry in os.scandir(self.output_dir) if entry.name.endswith('.folded')),
+                       key=lambda entry: entry.stat().st_mtime)
+        for entry in dumps[:-self.max_files]:
+            os.remove(entry.path)
+
+    def stats(self):
+        return {"stalls": self.stalls}
+
+class WatchdogMiddleware(BaseMiddleware):
+    """Labels each message's task for the watchdog and reports handlers that take longer than handler_budget seconds."""
+
+    def __init__(self, watchdog, handler_budget=2.0):
+        super().__init__()
+        self.watchdog = watchdog
+        self.handler_budget = handler_budget
+
+    async def on_process_message(self, message, data):
+        update = types.Update.get_current()
+        handler = current_handler.get().__name__
+        update_id = update.update_id if update is not None else message.message_id
+        self.watchdog.track(f"update {update_id} {handler}")
+        data['_watchdog_started'] = time.perf_counter()
+
+    async def on_post_process_message(self, message, results, data):
+        started = data.get('_watchdog_started')
+        if started is None:
+            return
+        label = self.watchdog.untrack()
+        elapsed = time.perf_counter() - started
+        if elapsed > self.handler_budget:
+            SLOW_HANDLERS.labels(label.rsplit(' ', 1)[-1] if label else 'unknown').inc()
+            logger.warning(f"Handling {label} took {elapsed:.2f}s (budget {self.handler_budget:.2f}s)")
+
+# Blocks the loop on purpose and measures what watching costs: python loop_watchdog.py
+if __name__ == "__main__":
+    import hashlib
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    def parse_document_in_the_loop():
+        # Stands in for a handler that parses a document without the process pool
+        digest = b''
+        for _ in range(200_000):
+            digest = hashlib.sha256(digest).digest()
+        time.sleep(0.1)
+
+    async def handle_update(update_id, watchdog):
+        watchdog.track(f"update {update_id} handle_document")
+        parse_document_in_the_loop()
+        watchdog.untrack()
+
+    async def throughput(seconds=2.0):
+        # Many short coroutines, as a busy bot would run
+        done = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            await asyncio.gather(*(asyncio.sleep(0) for _ in range(100)))
+            done += 100
+        return done / seconds
+
+    async def main(output_dir):
+        # Alternate unwatched and watched rounds and keep the best of each, since the machine's noise is larger than the cost
+        watchdog = LoopWatchdog(budget=0.05, sample_interval=0.005, output_dir=output_dir)
+        baseline = watched = 0
+        for _ in range(3):
+            baseline = max(baseline, await throughput())
+            watchdog.start()
+            watched = max(watched, await throughput())
+            watchdog.stop()
+        watchdog.start()
+        print(f"Loop throughput: {baseline:,.0f} coroutines/s unwatched, {watched:,.0f}/s watched "
+              f"({(baseline - watched) / baseline:+.1%} overhead)")
+
+        await handle_update(1, watchdog)
+        await asyncio.sleep(0.05)
+        watchdog.stop()
+        for name in os.listdir(output_dir):
+            print(f"{name}:")
+            with open(os.path.join(output_dir, name)) as f:
+                for line in f.readlines()[:5]:
+                    print(f"  {line.rstrip()[-150:]}")
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        asyncio.run(main(output_dir))
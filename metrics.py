@@ -0,0 +1,236 @@
+import bisect
+import logging
+import time
+from contextlib import nullcontext
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import RetryAfter
+
+# Spans are only recorded when OpenTelemetry is installed (and exported once its SDK is configured)
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from 1 ms to a minute
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        (registry if registry is not None else REGISTRY).append(self)
+
+    def labels(self, *values):
+        """Returns the child for one combination of label values, creating it on first use."""
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self.children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class Counter(_Metric):
+    """A Prometheus counter; call labels(...).inc(), or inc() when it has no labels.
+
+    For totals kept elsewhere, pass function to read the value (or a
+    label -> value dict) when the metrics are scraped.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, function=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.function = function
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def render(self):
+        if self.function is not None:
+            value = self.function()
+            if isinstance(value, dict):
+                for label, child_value in value.items():
+                    self.labels(label).set(child_value)
+            else:
+                self.labels().set(value)
+        return super().render()
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {child.value}"]
+
+class Gauge(Counter):
+    """A Prometheus gauge, which unlike a counter can also be set and go down."""
+    kind = 'gauge'
+
+    def set(self, value):
+        self.labels().set(value)
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class Histogram(_Metric):
+    """A Prometheus histogram; call labels(...).observe(value), or observe() when it has no labels."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, [('le', le)])} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {child.sum}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+REGISTRY = []
+
+def render(registry=None):
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in (registry if registry is not None else REGISTRY):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+HANDLER_LATENCY = Histogram('bot_handler_seconds', 'Time spent in each message handler.', ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Exceptions raised by message handlers.', ['exception'])
+API_LATENCY = Histogram('telegram_api_seconds', 'Time taken by Telegram Bot API calls.', ['method'])
+API_ERRORS = Counter('telegram_api_errors_total', 'Failed Telegram Bot API calls.', ['method', 'error'])
+API_RETRY_AFTER = Counter('telegram_api_retry_after_total', 'Telegram Bot API calls refused by flood control.', ['method'])
+DOWNLOAD_BYTES = Counter('telegram_download_bytes_total', 'Bytes of documents downloaded from Telegram.')
+DOWNLOAD_SPEED = Histogram('telegram_download_bytes_per_second', 'Download speed of each document.',
+                           buckets=(2 ** 16, 2 ** 18, 2 ** 20, 2 ** 22, 2 ** 24, 2 ** 26))
+EVENT_LOOP_LAG = Histogram('bot_event_loop_lag_seconds', 'How late the event loop ran a callback scheduled on time.',
+                           buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+LOOP_STALLS = Counter('bot_event_loop_stalls_total', 'Times the event loop was blocked for longer than the watchdog budget.')
+SLOW_HANDLERS = Counter('bot_slow_handlers_total', 'Handlers that took longer than the watchdog budget.', ['handler'])
+JOB_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+JOB_SECONDS = Histogram('bot_job_seconds', 'Time taken by each attempt at a queued job, by how it ended (completed, retried, postponed, failed or cancelled).', ['kind', 'outcome'],
+                        buckets=JOB_BUCKETS)
+JOB_WAIT_SECONDS = Histogram('bot_job_wait_seconds', 'Time from enqueueing a job to its first attempt starting.', ['kind'],
+                             buckets=JOB_BUCKETS)
+WORD_COUNT_SECONDS = Histogram('wordcount_seconds', 'Time taken to count the words in a document.', ['type'])
+WORD_COUNT_PAGE_SECONDS = Histogram('wordcount_page_seconds', 'Time taken to count the words on one PDF page.',
+                                    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+
+def span(name, **attributes):
+    """Returns a context manager tracing name as an OpenTelemetry span, or doing nothing without it."""
+    if trace is None:
+        return nullcontext()
+    return trace.get_tracer(__name__).start_as_current_span(name, attributes=attributes)
+
+class MetricsMiddleware(BaseMiddleware):
+    """Times every message handler by name and traces it as a span."""
+
+    async def on_process_message(self, message, data):
+        handler = current_handler.get()
+        data['_metrics_handler'] = handler.__name__
+        data['_metrics_started'] = time.perf_counter()
+        if trace is not None:
+            data['_metrics_span'] = trace.get_tracer(__name__).start_span(handler.__name__)
+
+    async def on_post_process_message(self, message, results, data):
+        started = data.get('_metrics_started')
+        if started is None:
+            return
+        HANDLER_LATENCY.labels(data['_metrics_handler']).observe(time.perf_counter() - started)
+        if '_metrics_span' in data:
+            data['_metrics_span'].end()
+
+class InstrumentedBot(Bot):
+    """A Bot that records the latency and failures of every Bot API call."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except RetryAfter:
+            API_RETRY_AFTER.labels(method).inc()
+            raise
+        except Exception as e:
+            API_ERRORS.labels(method, type(e).__name__).inc()
+            raise
+        finally:
+            API_LATENCY.labels(method).observe(time.perf_counter() - started)
+
+async def start_metrics_server(host, port, path='/metrics'):
+    """Serves the metrics on their own port; returns the runner to clean up on shutdown."""
+    async def handle(request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    app = web.Application()
+    app.router.add_get(path, handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}{path}")
+    return runner
+
+# Measures the cost of recording metrics: python metrics.py
+if __name__ == "__main__":
+    import timeit
+
+    registry = []
+    histogram = Histogram('example_seconds', 'Example histogram.', ['handler'], registry=registry)
+    counter = Counter('example_total', 'Example counter.', ['method'], registry=registry)
+    runs = 1_000_000
+    observe = timeit.timeit(lambda: histogram.labels('handle_document').observe(0.042), number=runs) / runs
+    inc = timeit.timeit(lambda: counter.labels('sendMessage').inc(), number=runs) / runs
+    print(f"Histogram.observe: {observe * 1e9:.0f} ns, Counter.inc: {inc * 1e9:.0f} ns")
+    print(render(registry))
@@ -0,0 +1,286 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from aiogram.utils.exceptions import NetworkError, RestartingTelegram, RetryAfter
+
+from throttling import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Lower numbers are sent first
+TEXT = 0  # Replies the user is waiting for
+EDIT = 1  # Progress updates, which are only cosmetic
+DOCUMENT = 2  # File uploads, which are slow and count the same against the limits
+
+class Outbox:
+    """Sends Bot API calls through one queue that keeps the bot inside Telegram's flood limits.
+
+    Each chat gets at most per_chat_rate calls per second (bursting to
+    per_chat_burst) and the bot as a whole global_rate. Calls to the same
+    chat go out one at a time in priority order, then in the order they
+    were queued. A 429 pauses that chat for the retry_after Telegram asks
+    for and the call is tried again, as are network errors, up to
+    max_retries times.
+    """
+
+    def __init__(self, per_chat_rate=1.0, per_chat_burst=3, global_rate=30.0, global_burst=30,
+                 max_in_flight=20, max_retries=5, retry_delay=1.0):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst, time.monotonic())
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.queue = []  # (priority, sequence, chat_id, call, future, attempts)
+        self.sequence = itertools.count()
+        self.chat_buckets = {}
+        self.blocked_until = {}  # chat_id -> when its retry_after ends
+        self.busy_chats = set()
+        self.in_flight = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.calls = set()  # Tasks of calls in flight, kept so they aren't garbage collected and can be stopped
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def send(self, call, chat_id, priority=TEXT):
+        """Queues call, a function returning the Bot API coroutine, and returns a future of its result."""
+        if self.task is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.sequence), chat_id, call, future, 0))
+        self.wakeup.set()
+        return future
+
+    def depth(self):
+        return len(self.queue)
+
+    def _chat_ready_at(self, chat_id, now):
+        # When the chat may be sent to next, or None if it is busy with another call
+        if chat_id in self.busy_chats:
+            return None
+        ready_at = self.blocked_until.get(chat_id, 0)
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is not None:
+            tokens = min(bucket.capacity, bucket.tokens + (now - bucket.updated) * bucket.rate)
+            if tokens < 1:
+                ready_at = max(ready_at, now + (1 - tokens) / bucket.rate)
+        return ready_at
+
+    def _next_sendable(self, now):
+        # Pops the first queued call whose chat may be sent to now; returns it and the earliest time another could be
+        skipped = []
+        found = None
+        wait_until = None
+        seen = set()
+        while self.queue:
+            entry = heapq.heappop(self.queue)
+            chat_id = entry[2]
+            ready_at = None if chat_id in seen else self._chat_ready_at(chat_id, now)
+            seen.add(chat_id)  # Later calls to a chat have to wait for its earlier ones
+            if ready_at is not None and ready_at <= now:
+                found = entry
+                break
+            if ready_at is not None and (wait_until is None or ready_at < wait_until):
+                wait_until = ready_at
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self.queue, entry)
+        return found, wait_until
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            if self.in_flight >= self.max_in_flight or not self.queue:
+                await self._wait(None)
+                continue
+            if not self.global_bucket.take(1, now):
+                await asyncio.sleep((1 - self.global_bucket.tokens) / self.global_bucket.rate)
+                continue
+            entry, wait_until = self._next_sendable(now)
+            if entry is None:
+                # Give the token back; nothing can use it yet
+                self.global_bucket.tokens += 1
+                await self._wait(None if wait_until is None else wait_until - now)
+                continue
+            chat_id = entry[2]
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst, now)
+            bucket.take(1, now)
+            self.blocked_until.pop(chat_id, None)
+            self.busy_chats.add(chat_id)
+            self.in_flight += 1
+            task = asyncio.create_task(self._call(entry))
+            self.calls.add(task)
+            task.add_done_callback(self.calls.discard)
+            if len(self.chat_buckets) > 1000:
+                self._sweep(now)
+
+    async def _wait(self, timeout):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _sweep(self, now):
+        # Forget chats whose buckets have refilled, so memory only grows with recently active chats
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items()
+                        if bucket.is_full(now) and chat_id not in self.busy_chats]:
+            del self.chat_buckets[chat_id]
+
+    async def _call(self, entry):
+        priority, sequence, chat_id, call, future, attempts = entry
+        retry_at = None
+        try:
+            if future.cancelled():
+                return
+            try:
+                result = await call()
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except RetryAfter as e:
+                retry_at = time.monotonic() + e.timeout
+                logger.warning(f"Flood control for chat {chat_id}, retrying in {e.timeout}s")
+                error = e
+            except (NetworkError, RestartingTelegram) as e:
+                retry_at = time.monotonic() + self.retry_delay * 2 ** attempts
+                error = e
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+                return
+            else:
+                self.sent += 1
+                if not future.done():
+                    future.set_result(result)
+                return
+
+            if attempts + 1 > self.max_retries:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(error)
+                return
+            self.retried += 1
+            self.blocked_until[chat_id] = retry_at
+            # The same sequence number keeps the call ahead of anything queued for the chat after it
+            heapq.heappush(self.queue, (priority, sequence, chat_id, call, future, attempts + 1))
+        finally:
+            self.busy_chats.discard(chat_id)
+            self.in_flight -= 1
+            self.wakeup.set()
+
+    def start(self):
+        self.task = asyncio.create_task(self._dispatch())
+
+    async def stop(self, timeout=10):
+        """Gives queued calls up to timeout seconds to go out, then cancels the rest, including calls in flight."""
+        deadline = time.monotonic() + timeout
+        while (self.queue or self.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        calls = list(self.calls)
+        for task in calls:
+            task.cancel()
+        await asyncio.gather(*calls, return_exceptions=True)
+        for entry in self.queue:
+            entry[4].cancel()
+        self.queue = []
+
+    def stats(self):
+        return {"queued": len(self.queue), "in_flight": self.in_flight, "sent": self.sent,
+                "retried": self.retried, "failed": self.failed}
+
+# Sends a burst of replies and documents to a fake Bot API that enforces flood limits:
+# python outbox.py [chats] [messages per chat]
+if __name__ == "__main__":
+    import statistics
+    import sys
+    from aiohttp import web
+    from aiogram import Bot
+    from aiogram.bot.api import TelegramAPIServer
+
+    TOKEN = "123456:fake-token"
+    CHAT_RATE, CHAT_BURST, GLOBAL_RATE = 1.0, 3, 30.0
+
+    class FloodLimitedAPI:
+        """Answers sendMessage/sendDocument, replying 429 like Telegram once a limit is exceeded."""
+
+        def __init__(self):
+            now = time.monotonic()
+            self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE, now)
+            self.chat_buckets = {}
+            self.flood_errors = 0
+
+        async def handle(self, request):
+            data = await request.post()
+            now = time.monotonic()
+            chat_id = data['chat_id']
+            bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(CHAT_RATE, CHAT_BURST, now))
+            if not bucket.take(1, now) or not self.global_bucket.take(1, now):
+                self.flood_errors += 1
+                return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                          "parameters": {"retry_after": 1}}, status=429)
+            if request.match_info['method'] == 'sendDocument':
+                await asyncio.sleep(0.05)  # Uploads take longer
+            return web.json_response({"ok": True, "result": {"message_id": 1, "date": 0, "chat": {"id": int(chat_id), "type": "private"}}})
+
+    async def run(chats, per_chat, use_outbox):
+        api = FloodLimitedAPI()
+        app = web.Application()
+        app.router.add_post(f"/bot{TOKEN}/{{method}}", api.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        bot = Bot(TOKEN, server=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}"))
+        outbox = Outbox(CHAT_RATE, CHAT_BURST, GLOBAL_RATE, GLOBAL_RATE)
+        latencies = {TEXT: [], DOCUMENT: []}
+        failures = 0
+
+        async def send(chat_id, priority):
+            nonlocal failures
+            started = time.perf_counter()
+            if priority == DOCUMENT:
+                call = lambda: bot.send_document(chat_id, "fake-file-id")
+            else:
+                call = lambda: bot.send_message(chat_id, "Document received. Counting words...")
+            try:
+                await (outbox.send(call, chat_id, priority) if use_outbox else call())
+            except Exception:
+                failures += 1
+                return
+            latencies[priority].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        # Every chat gets a document first, then its replies: without priorities the replies queue behind it
+        await asyncio.gather(*(send(chat_id, DOCUMENT) for chat_id in range(1, chats + 1)),
+                             *(send(chat_id, TEXT) for chat_id in range(1, chats + 1) for _ in range(per_chat)))
+        elapsed = time.perf_counter() - started
+        await outbox.stop()
+        await (await bot.get_session()).close()
+        await runner.cleanup()
+
+        label = "outbox" if use_outbox else "direct"
+        total = chats * (per_chat + 1)
+        print(f"{label}: {total - failures}/{total} delivered in {elapsed:.2f}s, {api.flood_errors} flood errors from the API")
+        for priority, name in ((TEXT, "text"), (DOCUMENT, "document")):
+            if latencies[priority]:
+                print(f"  {name} latency p50 {statistics.median(latencies[priority]):.2f}s, max {max(latencies[priority]):.2f}s")
+
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    per_chat = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(run(chats, per_chat, use_outbox=False))
+    asyncio.run(run(chats, per_chat, use_outbox=True))
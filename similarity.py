@@ -0,0 +1,363 @@
+import hashlib
+import random
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import deque
+
+from wordcount import count_words, count_words_in_pdf_pages, iter_document_text
+
+WORD = re.compile(r'\w+')
+
+def _hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little')
+
+def shingle_hashes(texts, size=5):
+    """Yields a 64-bit hash of every run of size consecutive words in a stream of text pieces.
+
+    Words are lowercased and stripped of punctuation, and runs carry on
+    across pieces, so the result doesn't depend on where pages or
+    paragraphs break. Text shorter than size words gives one shingle.
+    """
+    window = deque(maxlen=size)
+    seen = 0
+    for text in texts:
+        for word in WORD.findall(text.lower()):
+            window.append(word)
+            seen += 1
+            if seen >= size:
+                yield _hash(' '.join(window))
+    if 0 < seen < size:
+        yield _hash(' '.join(window))
+
+def _probe_sequence(bin_index, num_perm):
+    # The same bins are probed for a given empty bin in every signature, so densified values stay comparable
+    rng = random.Random(bin_index)
+    while True:
+        yield rng.randrange(num_perm)
+
+EMPTY_BIN = 1 << 32
+
+def _add_hash(bins, value):
+    index = value % len(bins)
+    value >>= 32
+    if value < bins[index]:
+        bins[index] = value
+
+def minhash(hashes, num_perm=128):
+    """Returns the one-permutation MinHash signature of a set of 64-bit hashes, or None if it is empty.
+
+    Each hash is dropped into one of num_perm bins by its low bits and
+    every bin keeps the smallest of its high 32 bits, so the signature
+    costs one pass whatever num_perm is. Bins left empty borrow the value
+    of a pseudo-randomly chosen filled bin (optimal densification), which
+    keeps the fraction of equal positions an unbiased estimate of the
+    Jaccard similarity of the two sets.
+    """
+    bins = [EMPTY_BIN] * num_perm
+    for value in hashes:
+        _add_hash(bins, value)
+    return _densify(bins)
+
+def _densify(bins):
+    num_perm = len(bins)
+    filled = [value != EMPTY_BIN for value in bins]
+    if not any(filled):
+        return None
+    for index in range(num_perm):
+        if not filled[index]:
+            for probe in _probe_sequence(index, num_perm):
+                if filled[probe]:
+                    bins[index] = bins[probe]
+                    break
+    return array('I', bins)
+
+class SignatureSketch:
+    """Builds the MinHash signature of text fed to it piece by piece, as shingle_hashes() and minhash() would.
+
+    It can be fed the same text a WordCounter is, so a document is only
+    read once for both. part() returns what combine_sketches() needs to
+    join the sketches of consecutive parts of a document, such as PDF page
+    ranges counted in different processes, into the signature of the whole.
+    """
+
+    def __init__(self, num_perm=128, shingle_size=5):
+        self.size = shingle_size
+        self.bins = [EMPTY_BIN] * num_perm
+        self.window = deque(maxlen=shingle_size)
+        self.head = []  # The first shingle_size - 1 words, for shingles that start in an earlier part
+        self.seen = 0
+
+    def feed(self, text):
+        for word in WORD.findall(text.lower()):
+            self.window.append(word)
+            self.seen += 1
+            if len(self.head) < self.size - 1:
+                self.head.append(word)
+            if self.seen >= self.size:
+                _add_hash(self.bins, _hash(' '.join(self.window)))
+
+    def part(self):
+        """Returns (bins, first words, last words, word count) for combine_sketches()."""
+        tail = list(self.window)[1:] if self.seen >= self.size else list(self.window)
+        return self.bins, self.head, tail, self.seen
+
+    def signature(self):
+        """Returns the signature of everything fed so far, or None if there were no words."""
+        return combine_sketches([self.part()], len(self.bins), self.size)
+
+def combine_sketches(parts, num_perm=128, shingle_size=5):
+    """Joins the part() results of consecutive parts of a document into its signature, or None if it has no words.
+
+    Shingles that run across the end of a part are made from the last
+    words of the parts before it and the first words of the next, so the
+    signature is the same however the document was split.
+    """
+    bins = [EMPTY_BIN] * num_perm
+    carry = []  # The last shingle_size - 1 words so far
+    seen = 0
+    for part_bins, head, tail, part_seen in parts:
+        bins = [min(a, b) for a, b in zip(bins, part_bins)]
+        for before in range(1, min(len(carry), shingle_size - 1) + 1):
+            after = shingle_size - before
+            if after <= len(head):
+                _add_hash(bins, _hash(' '.join(carry[-before:] + head[:after])))
+        carry = (carry + tail)[-(shingle_size - 1):] if shingle_size > 1 else []
+        seen += part_seen
+    if 0 < seen < shingle_size:
+        # Text shorter than a shingle is one shingle of its own
+        _add_hash(bins, _hash(' '.join(carry)))
+    return _densify(bins)
+
+def document_signature(file_path, num_perm=128, shingle_size=5):
+    """Reads a DOCX or PDF file and returns its MinHash signature, or None if it has no words.
+
+    This is CPU-heavy, so the bot runs it in its extraction pool.
+    """
+    sketch = SignatureSketch(num_perm, shingle_size)
+    for text in iter_document_text(file_path):
+        sketch.feed(text)
+    return sketch.signature()
+
+def count_words_with_signature(file_path, exclude_quotes=False, exclude_bibliography=False):
+    """Counts a document's words and makes its signature in the same pass; returns (count_words() result, signature)."""
+    sketch = SignatureSketch()
+    counted = count_words(file_path, exclude_quotes, exclude_bibliography, on_text=sketch.feed)
+    return counted, sketch.signature()
+
+def count_pdf_pages_with_signature(file_path, start, stop, exclude_quotes=False, exclude_bibliography=False):
+    """Counts pages start..stop-1 of a PDF and sketches them in the same pass.
+
+    Returns (count_words_in_pdf_pages() result, sketch part), to be joined
+    with combine_counts() and combine_sketches().
+    """
+    sketch = SignatureSketch()
+    counted = count_words_in_pdf_pages(file_path, start, stop, exclude_quotes, exclude_bibliography, on_text=sketch.feed)
+    return counted, sketch.part()
+
+def similarity(signature, other):
+    """Estimates the Jaccard similarity of the documents two signatures were made from."""
+    return sum(a == b for a, b in zip(signature, other)) / len(signature)
+
+class SimilarityIndex:
+    """Finds stored documents that nearly duplicate a new one, using MinHash signatures and LSH.
+
+    Signatures are kept in SQLite next to a locality-sensitive hashing
+    index: each signature is cut into bands of rows, and documents that
+    agree on every row of any band become candidates. With the default
+    32 bands of 4 rows, a document with a Jaccard similarity of 0.8 is
+    practically always a candidate, one of 0.5 seven times in eight and
+    one of 0.2 one time in twenty, so a query reads a few index entries
+    rather than every signature. Adding a document only inserts its own
+    rows. A document added with its stored path can be dropped by that
+    path with remove_path() once the store deletes it.
+    """
+
+    def __init__(self, db_path, num_perm=128, bands=32):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.db_path = db_path
+        self.local = threading.local()
+        db = self._connect()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS signatures ("
+            " document_id INTEGER PRIMARY KEY,"
+            " sha256 TEXT,"
+            " signature BLOB NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " path TEXT)"
+        )
+        # Indexes from before paths were kept get the column; their old entries just can't be removed by path
+        columns = [row[1] for row in db.execute("PRAGMA table_info(signatures)")]
+        if 'path' not in columns:
+            db.execute("ALTER TABLE signatures ADD COLUMN path TEXT")
+        db.execute("CREATE INDEX IF NOT EXISTS signatures_sha256 ON signatures (sha256)")
+        db.execute("CREATE INDEX IF NOT EXISTS signatures_path ON signatures (path)")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS bands ("
+            " band INTEGER NOT NULL,"
+            " hash INTEGER NOT NULL,"
+            " document_id INTEGER NOT NULL,"
+            " PRIMARY KEY (band, hash, document_id)) WITHOUT ROWID"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS bands_document ON bands (document_id)")
+        self.queries = 0
+        self.candidates = 0
+
+    def _connect(self):
+        # One connection per thread so documents can be removed from the store's sweeper thread
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            # The index can always be rebuilt from the documents, so it doesn't need every commit synced
+            db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _band_hashes(self, signature):
+        rows = self.rows
+        for band in range(self.bands):
+            digest = hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8).digest()
+            yield band, int.from_bytes(digest, 'little', signed=True)
+
+    def get_signature(self, sha256):
+        """Returns the signature already stored for this content, or None."""
+        row = self._connect().execute("SELECT signature FROM signatures WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone()
+        return array('I', row[0]) if row is not None else None
+
+    def add(self, document_id, signature, sha256=None, path=None):
+        """Indexes a document's signature, replacing any earlier one for the same document_id."""
+        db = self._connect()
+        db.execute("BEGIN")
+        try:
+            db.execute("DELETE FROM bands WHERE document_id = ?", (document_id,))
+            db.execute("INSERT OR REPLACE INTO signatures (document_id, sha256, signature, created_at, path) VALUES (?, ?, ?, ?, ?)",
+                       (document_id, sha256, signature.tobytes(), time.time(), path))
+            db.executemany("INSERT OR IGNORE INTO bands (band, hash, document_id) VALUES (?, ?, ?)",
+                           ((band, band_hash, document_id) for band, band_hash in self._band_hashes(signature)))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def remove(self, document_id):
+        db = self._connect()
+        db.execute("BEGIN")
+        try:
+            db.execute("DELETE FROM bands WHERE document_id = ?", (document_id,))
+            db.execute("DELETE FROM signatures WHERE document_id = ?", (document_id,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def remove_path(self, path):
+        """Drops the document stored at path, if it was indexed; for DocumentStore's on_remove."""
+        row = self._connect().execute("SELECT document_id FROM signatures WHERE path = ?", (path,)).fetchone()
+        if row is not None:
+            self.remove(row[0])
+
+    def query(self, signature, top=5, min_similarity=0.5, exclude=None):
+        """Returns up to top (document_id, estimated similarity) pairs at or above min_similarity, best first."""
+        db = self._connect()
+        self.queries += 1
+        candidates = set()
+        for band, band_hash in self._band_hashes(signature):
+            candidates.update(document_id for (document_id,) in db.execute(
+                "SELECT document_id FROM bands WHERE band = ? AND hash = ?", (band, band_hash)))
+        candidates.discard(exclude)
+        self.candidates += len(candidates)
+        matches = []
+        for document_id in candidates:
+            row = db.execute("SELECT signature FROM signatures WHERE document_id = ?", (document_id,)).fetchone()
+            if row is None:
+                continue
+            score = similarity(signature, array('I', row[0]))
+            if score >= min_similarity:
+                matches.append((document_id, score))
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        return matches[:top]
+
+    def stats(self):
+        documents, = self._connect().execute("SELECT COUNT(*) FROM signatures").fetchone()
+        return {
+            "documents": documents,
+            "queries": self.queries,
+            "candidates_per_query": self.candidates / self.queries if self.queries else 0.0,
+        }
+
+# Indexes synthetic documents and looks up near-duplicates: python similarity.py [documents]
+if __name__ == "__main__":
+    import os
+    import statistics
+    import sys
+    import tempfile
+
+    documents = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    shingles_per_document = 200
+    probes = 200
+
+    def random_shingles(rng):
+        return [rng.getrandbits(64) for _ in range(shingles_per_document)]
+
+    def edit(shingles, rng, fraction):
+        """Replaces a fraction of a document's shingles, like a resubmission with some sentences reworded."""
+        edited = list(shingles)
+        for index in rng.sample(range(len(edited)), int(len(edited) * fraction)):
+            edited[index] = rng.getrandbits(64)
+        return edited
+
+    rng = random.Random(1)
+    words = [f"word{number}" for number in range(5000)]
+    text = " ".join(rng.choices(words, k=5000))
+    started = time.perf_counter()
+    for _ in range(10):
+        minhash(shingle_hashes([text]))
+    print(f"Signature of a 5000 word text: {(time.perf_counter() - started) * 100:.1f} ms")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'similarity.db')
+        index = SimilarityIndex(db_path)
+        originals = {}
+        add_times = []
+        started = time.perf_counter()
+        for document_id in range(1, documents + 1):
+            shingles = random_shingles(rng)
+            if document_id % (documents // probes) == 0:
+                originals[document_id] = shingles
+            signature = minhash(shingles)
+            added = time.perf_counter()
+            index.add(document_id, signature)
+            add_times.append(time.perf_counter() - added)
+        elapsed = time.perf_counter() - started
+        size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+        print(f"Indexed {documents} documents in {elapsed:.1f}s (add p50 {statistics.median(add_times) * 1000:.2f} ms), "
+              f"{size / 1024 / 1024:.0f} MB on disk")
+
+        for fraction in (0.05, 0.2, 0.5):
+            found, query_times = 0, []
+            for document_id, shingles in originals.items():
+                signature = minhash(edit(shingles, rng, fraction))
+                started = time.perf_counter()
+                matches = index.query(signature, top=3, min_similarity=0.5)
+                query_times.append(time.perf_counter() - started)
+                found += bool(matches) and matches[0][0] == document_id
+            # Replacing a fraction f of the shingles leaves a Jaccard similarity of (1 - f) / (1 + f)
+            print(f"{fraction:.0%} of shingles changed (Jaccard {(1 - fraction) / (1 + fraction):.2f}): "
+                  f"found {found}/{len(originals)}, query p50 {statistics.median(query_times) * 1000:.2f} ms, "
+                  f"p99 {statistics.quantiles(query_times, n=100)[98] * 1000:.2f} ms")
+
+        unrelated = sum(bool(index.query(minhash(random_shingles(rng)), min_similarity=0.5)) for _ in range(probes))
+        print(f"Unrelated documents flagged: {unrelated}/{probes}; {index.stats()}")
+
+        # The same lookup without LSH: compare against every stored signature
+        signature = minhash(edit(next(iter(originals.values())), rng, 0.05))
+        started = time.perf_counter()
+        best = max((similarity(signature, array('I', blob)), document_id)
+                   for document_id, blob in index._connect().execute("SELECT document_id, signature FROM signatures"))
+        print(f"Linear scan of every signature: {(time.perf_counter() - started) * 1000:.0f} ms (best match {best[1]})")
@@ -0,0 +1,76 @@
+import os
+import re
+import subprocess
+import sys
+import time
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# Fallback for process_uptime() where /proc isn't available
+IMPORTED_AT = time.monotonic()
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def process_uptime():
+    """Returns the number of seconds since this process started, interpreter start-up included."""
+    try:
+        with open('/proc/self/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        started = int(fields[19]) / os.sysconf('SC_CLK_TCK')  # starttime, in clock ticks after boot
+        with open('/proc/uptime') as uptime:
+            return float(uptime.read().split()[0]) - started
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - IMPORTED_AT
+
+def profile_imports(module='bot', top=25, cwd=None):
+    """Imports module in a fresh interpreter under -X importtime and summarises the result.
+
+    Returns a report of the total import time and the top slowest of the
+    module's direct imports by cumulative time.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    # Children are listed before their parent, so collect the top-level entries until the module's own line
+    total, direct, pending = 0, [], []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        depth = len(indent) // 2
+        if depth == 1:
+            pending.append((int(cumulative_us), int(self_us), name))
+        elif depth == 0:
+            if name == module:
+                total, direct = int(cumulative_us), pending
+            pending = []
+
+    direct = sorted(direct, reverse=True)[:top]
+    lines = [f"import {module}: {total / 1000:.1f} ms", f"{'cumulative':>12} {'self':>10}  module"]
+    lines += [f"{cumulative / 1000:>9.1f} ms {self_us / 1000:>7.1f} ms  {name}"
+              for cumulative, self_us, name in direct]
+    return "\n".join(lines)
+
+class FirstUpdateLogger(BaseMiddleware):
+    """Logs how long after the process started the first message arrived.
+
+    Messages rather than updates, since webhook mode hands updates straight
+    to Dispatcher.process_update, which skips the update middleware hooks.
+    """
+
+    def __init__(self, logger):
+        super().__init__()
+        self.logger = logger
+        self.logged = False
+
+    async def on_pre_process_message(self, message, data):
+        if not self.logged:
+            self.logged = True
+            self.logger.info(f"Time to first update: {process_uptime():.2f}s after process start")
+
+# Prints the import profile of a module: python startup.py [module]
+if __name__ == "__main__":
+    print(profile_imports(sys.argv[1] if len(sys.argv) > 1 else 'bot'))
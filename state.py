@@ -0,0 +1,159 @@
+import asyncio
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+
+def _encode(record):
+    return json.dumps(record, separators=(',', ':'))
+
+def _decode(data):
+    return json.loads(data)
+
+class MemoryStateStore:
+    """Keeps conversation state in process memory.
+
+    Used for single-process deployments and as a stand-in for the shared
+    backends in tests. Records untouched for ttl seconds are evicted.
+    """
+
+    def __init__(self, ttl=86400):
+        self.ttl = ttl
+        self.records = OrderedDict()  # user_id -> (expires_at, record), oldest first
+
+    async def start(self):
+        pass
+
+    async def get(self, user_id):
+        entry = self.records.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    async def set(self, user_id, record):
+        self.records[user_id] = (time.monotonic() + self.ttl, record)
+        self.records.move_to_end(user_id)
+        self._evict_expired()
+
+    async def delete(self, user_id):
+        self.records.pop(user_id, None)
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        while self.records:
+            user_id, (expires_at, _) = next(iter(self.records.items()))
+            if expires_at >= now:
+                break
+            del self.records[user_id]
+
+    async def close(self):
+        pass
+
+class SQLiteStateStore:
+    """Keeps conversation state in a SQLite database that survives restarts.
+
+    Writes are buffered and flushed in one transaction every
+    flush_interval seconds (and on close), so a burst of messages costs one
+    commit instead of one per message.
+    """
+
+    def __init__(self, db_path, ttl=86400, flush_interval=1.0):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.pending = {}  # user_id -> encoded record, or None for a delete
+        self.flush_task = None
+        self.db = sqlite3.connect(db_path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS user_states ("
+            " user_id INTEGER PRIMARY KEY,"
+            " record TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS user_states_updated_at ON user_states (updated_at)")
+
+    async def start(self):
+        self.flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def get(self, user_id):
+        if user_id in self.pending:
+            data = self.pending[user_id]
+            return None if data is None else _decode(data)
+        row = self.db.execute(
+            "SELECT record FROM user_states WHERE user_id = ? AND updated_at >= ?",
+            (user_id, time.time() - self.ttl),
+        ).fetchone()
+        return None if row is None else _decode(row[0])
+
+    async def set(self, user_id, record):
+        self.pending[user_id] = _encode(record)
+
+    async def delete(self, user_id):
+        self.pending[user_id] = None
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        now = time.time()
+        self.db.execute("BEGIN")
+        for user_id, data in pending.items():
+            if data is None:
+                self.db.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+            else:
+                self.db.execute("INSERT OR REPLACE INTO user_states (user_id, record, updated_at) VALUES (?, ?, ?)",
+                                (user_id, data, now))
+        self.db.execute("DELETE FROM user_states WHERE updated_at < ?", (now - self.ttl,))
+        self.db.execute("COMMIT")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.pending:
+                self.flush()
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        self.flush()
+        self.db.close()
+
+class RedisStateStore:
+    """Keeps conversation state in Redis (or anything speaking its protocol) so several bot processes can share it.
+
+    Redis expires abandoned records itself. A ready-made client (for
+    example a fakeredis instance in tests) can be passed instead of a URL.
+    """
+
+    def __init__(self, url=None, ttl=86400, client=None, prefix='bot:state:'):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def start(self):
+        pass
+
+    async def get(self, user_id):
+        data = await self.client.get(f"{self.prefix}{user_id}")
+        return None if data is None else _decode(data)
+
+    async def set(self, user_id, record):
+        await self.client.set(f"{self.prefix}{user_id}", _encode(record), ex=self.ttl)
+
+    async def delete(self, user_id):
+        await self.client.delete(f"{self.prefix}{user_id}")
+
+    async def close(self):
+        await self.client.close()
+
+def create_state_store(backend, ttl=86400, db_path=None, redis_url=None, flush_interval=1.0):
+    """Creates the state store for the configured backend: memory, sqlite or redis."""
+    if backend == 'memory':
+        return MemoryStateStore(ttl=ttl)
+    elif backend == 'sqlite':
+        return SQLiteStateStore(db_path, ttl=ttl, flush_interval=flush_interval)
+    elif backend == 'redis':
+        return RedisStateStore(redis_url, ttl=ttl)
+    else:
+        raise ValueError(f"Unknown state backend: {backend}. Use memory, sqlite or redis.")
@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Cold documents are only compressed when zstandard is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+class DocumentStore:
+    """Keeps uploaded documents on disk with bounded growth.
+
+    Documents live at root/docs/<id // shard_size>/<id>_<name>, so no
+    directory grows past shard_size entries. Every document is a hardlink
+    to a blob named by its SHA-256 under root/blobs, so identical uploads
+    share one copy on disk, and a SQLite database keeps the reference
+    counts. A background sweeper deletes documents older than retention
+    seconds, then the oldest ones while the blobs take up more than quota
+    bytes, and compresses blobs unused for compress_after seconds with
+    zstd. A compressed document's path disappears, but its content is kept
+    until retention or the quota removes it, and comes back if it is
+    uploaded again.
+    A zero retention, quota or compress_after turns that policy off.
+    on_remove(path) is called after a document is deleted, from the
+    sweeper's thread when the sweeper deletes it.
+    """
+
+    def __init__(self, root, db_path, shard_size=1000, retention=0, quota=0, compress_after=0, on_remove=None):
+        self.root = root
+        self.docs_dir = os.path.join(root, 'docs')
+        self.blobs_dir = os.path.join(root, 'blobs')
+        self.db_path = db_path
+        self.shard_size = shard_size
+        self.retention = retention
+        self.quota = quota
+        self.compress_after = compress_after
+        self.on_remove = on_remove
+        if compress_after and zstandard is None:
+            logger.warning("zstandard is not installed, cold documents will not be compressed")
+            self.compress_after = 0
+        self.local = threading.local()
+        # Held while the links and reference counts of a blob change, since the sweeper runs in a thread
+        self.lock = threading.Lock()
+        self.task = None
+        self.removed = 0
+        self.deduplicated = 0
+        self.compressed = 0
+        os.makedirs(self.docs_dir, exist_ok=True)
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        db = self._connect()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " sha256 TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " stored_size INTEGER NOT NULL,"
+            " refcount INTEGER NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " compressed INTEGER NOT NULL DEFAULT 0)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY,"
+            " sha256 TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS files_created ON files (created_at)")
+        db.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        db.execute("CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (compressed, last_used)")
+
+    def _connect(self):
+        # One connection per thread so the sweeper can run in a worker thread
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def _blob_path(self, sha256, compressed=False):
+        return os.path.join(self.blobs_dir, sha256[:2], sha256 + ('.zst' if compressed else ''))
+
+    def path_for(self, document_id, file_name):
+        """Returns the path to store a document under, creating its shard directory."""
+        shard = os.path.join(self.docs_dir, f"{document_id // self.shard_size:04d}")
+        os.makedirs(shard, exist_ok=True)
+        return os.path.join(shard, f"{document_id}_{os.path.basename(file_name)}")
+
+    def add(self, path, sha256, size):
+        """Registers a document just written to path, whose content has the given SHA-256.
+
+        If the same content is already stored, path is replaced by a link
+        to it and the new copy's disk space is freed straight away.
+        """
+        blob_path = self._blob_path(sha256)
+        now = time.time()
+        with self.lock:
+            db = self._connect()
+            # A retried download may overwrite a document that is already stored
+            previous = db.execute("SELECT sha256 FROM files WHERE path = ?", (path,)).fetchone()
+            if previous is not None:
+                db.execute("DELETE FROM files WHERE path = ?", (path,))
+                self._release(db, previous[0])
+            row = db.execute("SELECT compressed FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+            if row is None:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                self._link(path, blob_path)
+                db.execute("INSERT INTO blobs (sha256, size, stored_size, refcount, last_used) VALUES (?, ?, ?, 1, ?)",
+                           (sha256, size, size, now))
+            else:
+                if row[0]:
+                    # This content went cold, but the fresh upload can stand in for the compressed copy
+                    self._link(path, blob_path)
+                    os.remove(self._blob_path(sha256, compressed=True))
+                    self._relink(db, sha256, blob_path)
+                else:
+                    self._link(blob_path, path)
+                    self.deduplicated += 1
+                db.execute("UPDATE blobs SET refcount = refcount + 1, last_used = ?, compressed = 0, stored_size = size"
+                           " WHERE sha256 = ?", (now, sha256))
+            db.execute("INSERT OR REPLACE INTO files (path, sha256, created_at) VALUES (?, ?, ?)", (path, sha256, now))
+
+    def _link(self, source, path):
+        # Link next to the target and rename over it, so path always holds a complete file
+        temp_path = os.path.join(os.path.dirname(path), f".link-{os.getpid()}-{threading.get_ident()}")
+        os.link(source, temp_path)
+        os.replace(temp_path, path)
+
+    def _relink(self, db, sha256, blob_path):
+        for (path,) in db.execute("SELECT path FROM files WHERE sha256 = ?", (sha256,)).fetchall():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._link(blob_path, path)
+
+    def _release(self, db, sha256):
+        # Drops one reference to a blob, deleting it with the last one; returns the bytes freed
+        db.execute("UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?", (sha256,))
+        refcount, compressed, stored_size = db.execute(
+            "SELECT refcount, compressed, stored_size FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        if refcount > 0:
+            return 0
+        os.remove(self._blob_path(sha256, compressed))
+        db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        return stored_size
+
+    def remove(self, path):
+        """Deletes a stored document, and its content once no other document shares it.
+
+        Returns the number of bytes freed on disk.
+        """
+        with self.lock:
+            db = self._connect()
+            row = db.execute("SELECT sha256 FROM files WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return 0
+            db.execute("DELETE FROM files WHERE path = ?", (path,))
+            if os.path.exists(path):
+                os.remove(path)
+            self.removed += 1
+            freed = self._release(db, row[0])
+        if self.on_remove is not None:
+            self.on_remove(path)
+        return freed
+
+    def _compress(self, sha256):
+        blob_path = self._blob_path(sha256)
+        compressed_path = self._blob_path(sha256, compressed=True)
+        with self.lock:
+            db = self._connect()
+            row = db.execute("SELECT compressed, last_used FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+            if row is None or row[0]:
+                return
+            last_used = row[1]
+            # The open file stays readable even if the blob is deleted while it is being compressed
+            source = open(blob_path, 'rb')
+        # Compressing takes a while, so add() isn't kept waiting for it
+        with source:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path), suffix='.part')
+            with os.fdopen(fd, 'wb') as target:
+                zstandard.ZstdCompressor(level=10).copy_stream(source, target)
+        with self.lock:
+            # The blob may have been used, deleted or compressed by someone else in the meantime
+            row = db.execute("SELECT compressed, last_used FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+            if row is None or row[0] or row[1] != last_used:
+                os.remove(temp_path)
+                return
+            os.replace(temp_path, compressed_path)
+            for (path,) in db.execute("SELECT path FROM files WHERE sha256 = ?", (sha256,)).fetchall():
+                if os.path.exists(path):
+                    os.remove(path)
+            os.remove(blob_path)
+            db.execute("UPDATE blobs SET compressed = 1, stored_size = ? WHERE sha256 = ?",
+                       (os.path.getsize(compressed_path), sha256))
+            self.compressed += 1
+
+    def usage(self):
+        """Returns the number of bytes the stored documents take up on disk."""
+        return self._connect().execute("SELECT COALESCE(SUM(stored_size), 0) FROM blobs").fetchone()[0]
+
+    def sweep(self):
+        """Applies the retention, quota and compression policies once."""
+        db = self._connect()
+        now = time.time()
+        if self.retention:
+            for (path,) in db.execute("SELECT path FROM files WHERE created_at < ?", (now - self.retention,)).fetchall():
+                self.remove(path)
+        if self.quota:
+            usage = self.usage()
+            while usage > self.quota:
+                row = db.execute("SELECT path FROM files ORDER BY created_at LIMIT 1").fetchone()
+                if row is None:
+                    break
+                usage -= self.remove(row[0])
+        if self.compress_after:
+            for (sha256,) in db.execute("SELECT sha256 FROM blobs WHERE compressed = 0 AND last_used < ?",
+                                        (now - self.compress_after,)).fetchall():
+                self._compress(sha256)
+
+    async def _sweep_forever(self, interval):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception:
+                logger.exception("Sweeping the document store failed")
+            await asyncio.sleep(interval)
+
+    def start(self, interval=3600):
+        """Starts sweeping every interval seconds on the running event loop."""
+        if self.retention or self.quota or self.compress_after:
+            self.task = asyncio.create_task(self._sweep_forever(interval))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def stats(self):
+        db = self._connect()
+        files, = db.execute("SELECT COUNT(*) FROM files").fetchone()
+        blobs, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {
+            "files": files,
+            "blobs": blobs,
+            "bytes": size,
+            "bytes_on_disk": self.usage(),
+            "deduplicated": self.deduplicated,
+            "removed": self.removed,
+            "compressed": self.compressed,
+        }
+
+# Stores a batch of documents with repeats and sweeps them: python storage.py [documents]
+if __name__ == "__main__":
+    import hashlib
+    import random
+    import sys
+
+    documents = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as root:
+        quota = documents * 400  # About half of the distinct content
+        store = DocumentStore(root, os.path.join(root, 'storage.db'), retention=3600, quota=quota)
+        words = ["essay", "student", "analysis", "the", "of", "research", "argument", "evidence", "and", "conclusion"]
+        # Every document is uploaded five times on average
+        contents = [" ".join(random.choices(words, k=600)).encode() for _ in range(documents // 5)]
+        started = time.perf_counter()
+        for document_id in range(1, documents + 1):
+            content = random.choice(contents)
+            path = store.path_for(document_id, 'essay.docx')
+            with open(path, 'wb') as file:
+                file.write(content)
+            store.add(path, hashlib.sha256(content).hexdigest(), len(content))
+        elapsed = time.perf_counter() - started
+        print(f"Stored {documents} documents in {elapsed:.2f}s ({documents / elapsed:.0f}/s)")
+        print(f"  {store.stats()}")
+
+        paths = [store.path_for(random.randint(1, documents), 'essay.docx') for _ in range(1000)]
+        started = time.perf_counter()
+        for path in paths:
+            os.path.exists(path)
+        print(f"os.path.exists on a sharded path: {(time.perf_counter() - started) * 1000:.1f} us")
+
+        started = time.perf_counter()
+        store.sweep()
+        print(f"Swept down to the {quota // 1024} KiB quota in {time.perf_counter() - started:.2f}s")
+        print(f"  {store.stats()}")
+
+        if zstandard is not None:
+            store.compress_after = 1e-9
+            store.sweep()
+            # Content that is still stored, so it is compressed now
+            content = next(content for content in contents if store._connect().execute(
+                "SELECT 1 FROM blobs WHERE sha256 = ?", (hashlib.sha256(content).hexdigest(),)).fetchone())
+            path = store.path_for(documents + 1, 'essay.docx')
+            with open(path, 'wb') as file:
+                file.write(content)
+            store.add(path, hashlib.sha256(content).hexdigest(), len(content))
+            print(f"Compressed every blob and uploaded one again; {os.path.exists(path)=}")
+            print(f"  {store.stats()}")
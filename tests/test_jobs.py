@@ -0,0 +1,141 @@
+import asyncio
+import time
+
+import pytest
+
+from jobs import AsyncWorkers, JobQueue, PermanentJobError, RetryLater
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / 'jobs.db'), max_attempts=2, retry_delay=0, lease_time=60)
+
+def test_claim_leases_the_oldest_job(queue):
+    first = queue.enqueue('document', {'n': 1})
+    queue.enqueue('document', {'n': 2})
+    job = queue.claim()
+    assert (job.id, job.kind, job.payload, job.attempts) == (first, 'document', {'n': 1}, 1)
+    assert queue.claim().payload == {'n': 2}
+    assert queue.claim() is None
+
+def test_expired_lease_is_claimed_again(queue):
+    queue.lease_time = 0
+    queue.enqueue('document', {})
+    assert queue.claim().attempts == 1
+    assert queue.claim().attempts == 2
+
+def test_renew_extends_the_lease_and_saves_the_payload(queue):
+    queue.lease_time = 0
+    queue.enqueue('document', {})
+    job = queue.claim()
+    queue.lease_time = 60
+    job.payload['done'] = [1]
+    queue.renew(job)
+    assert queue.claim() is None
+    (payload,) = queue._connect().execute("SELECT payload FROM jobs WHERE id = ?", (job.id,)).fetchone()
+    assert payload == '{"done": [1]}'
+
+def test_release_requeues_without_counting_the_attempt(queue):
+    queue.enqueue('batch', {})
+    job = queue.claim()
+    job.payload['done'] = {'7': ['7_essay.docx', 100, '100 words']}
+    queue.release(job)
+    job = queue.claim()
+    assert job.attempts == 1
+    assert job.payload == {'done': {'7': ['7_essay.docx', 100, '100 words']}}
+
+def test_postpone_waits_without_counting_the_attempt(queue):
+    queue.enqueue('document', {})
+    job = queue.claim()
+    job.payload['busy_notified'] = True
+    queue.postpone(job, 60)
+    assert queue.claim() is None
+    queue._connect().execute("UPDATE jobs SET available_at = ?", (time.time(),))
+    job = queue.claim()
+    assert (job.attempts, job.payload) == (1, {'busy_notified': True})
+
+def test_fail_retries_until_attempts_run_out(queue):
+    queue.enqueue('document', {})
+    job = queue.claim()
+    job.payload['step'] = 1
+    assert queue.fail(job, ValueError('boom'))
+    job = queue.claim()
+    assert (job.attempts, job.payload) == (2, {'step': 1})
+    assert not queue.fail(job, ValueError('boom'))
+    assert queue.claim() is None
+    assert queue.stats()['failed'] == 1
+
+def test_fail_without_retry_fails_straight_away(queue):
+    queue.enqueue('document', {})
+    assert not queue.fail(queue.claim(), ValueError('bad file'), retry=False)
+    assert queue.stats()['failed'] == 1
+
+def test_complete_removes_the_job(queue):
+    queue.enqueue('document', {})
+    queue.complete(queue.claim())
+    stats = queue.stats()
+    assert (stats['queued'], stats['running'], stats['completed']) == (0, 0, 1)
+
+def run_workers(queue, handlers, seconds=0.5):
+    failures = []
+
+    async def on_failure(job, error):
+        failures.append((job.kind, type(error)))
+
+    async def main():
+        workers = AsyncWorkers(queue, handlers, workers=1, poll_interval=0.01, on_failure=on_failure)
+        workers.start()
+        await asyncio.sleep(seconds)
+        await workers.stop()
+
+    asyncio.run(main())
+    return failures
+
+def test_workers_retry_then_report_the_failure(queue):
+    attempts = []
+
+    async def handler(payload):
+        attempts.append(payload.get('tries', 0))
+        payload['tries'] = payload.get('tries', 0) + 1
+        raise ValueError('boom')
+
+    queue.enqueue('document', {})
+    assert run_workers(queue, {'document': handler}) == [('document', ValueError)]
+    assert attempts == [0, 1]
+
+def test_workers_fail_permanent_errors_once(queue):
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload)
+        raise PermanentJobError('unreadable')
+
+    queue.enqueue('document', {})
+    assert run_workers(queue, {'document': handler}) == [('document', PermanentJobError)]
+    assert len(calls) == 1
+
+def test_workers_postpone_without_using_attempts(queue):
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload)
+        if len(calls) <= queue.max_attempts:
+            raise RetryLater(0)
+
+    queue.enqueue('document', {})
+    assert run_workers(queue, {'document': handler}) == []
+    assert len(calls) == queue.max_attempts + 1
+    assert queue.stats()['completed'] == 1
+
+def test_stopping_workers_releases_the_running_job(queue):
+    started = []
+
+    async def handler(payload):
+        payload['step'] = 1
+        started.append(True)
+        await asyncio.sleep(60)
+
+    queue.enqueue('document', {})
+    run_workers(queue, {'document': handler}, seconds=0.2)
+    assert started == [True]
+    job = queue.claim()
+    assert (job.attempts, job.payload) == (1, {'step': 1})
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.utils.exceptions import BadRequest, NetworkError, RetryAfter
+
+from outbox import DOCUMENT, EDIT, TEXT, Outbox
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def recorder(sent, name, errors=()):
+    # Returns a call that raises the given errors in turn, then records name as sent
+    errors = list(errors)
+
+    async def call():
+        if errors:
+            raise errors.pop(0)
+        sent.append(name)
+        return name
+    return lambda: call()
+
+def test_sends_higher_priority_calls_first():
+    async def main():
+        outbox = Outbox(per_chat_burst=10)
+        sent = []
+        futures = [outbox.send(recorder(sent, 'document'), 1, DOCUMENT),
+                   outbox.send(recorder(sent, 'edit'), 1, EDIT),
+                   outbox.send(recorder(sent, 'text 1'), 1, TEXT),
+                   outbox.send(recorder(sent, 'text 2'), 1, TEXT)]
+        await asyncio.gather(*futures)
+        await outbox.stop()
+        return sent
+
+    assert run(main()) == ['text 1', 'text 2', 'edit', 'document']
+
+def test_retry_after_pauses_the_chat_and_keeps_its_place():
+    async def main():
+        outbox = Outbox(per_chat_burst=10)
+        sent = []
+        started = time.monotonic()
+        first = outbox.send(recorder(sent, 'first', [RetryAfter(1)]), 1)
+        second = outbox.send(recorder(sent, 'second'), 1)
+        other_chat = outbox.send(recorder(sent, 'other chat'), 2)
+        assert await other_chat == 'other chat'
+        assert await first == 'first'
+        waited = time.monotonic() - started
+        await second
+        await outbox.stop()
+        return sent, waited, outbox.stats()
+
+    sent, waited, stats = run(main())
+    # Only the chat Telegram limited waits, and its calls stay in order
+    assert sent == ['other chat', 'first', 'second']
+    assert waited >= 1
+    assert (stats['sent'], stats['retried'], stats['failed']) == (3, 1, 0)
+
+def test_network_errors_are_retried_up_to_max_retries():
+    async def main():
+        outbox = Outbox(max_retries=2, retry_delay=0.01)
+        sent = []
+        recovered = outbox.send(recorder(sent, 'recovered', [NetworkError('reset')] * 2), 1)
+        assert await recovered == 'recovered'
+        with pytest.raises(NetworkError):
+            await outbox.send(recorder(sent, 'lost', [NetworkError('reset')] * 3), 2)
+        await outbox.stop()
+        return outbox.stats()
+
+    stats = run(main())
+    assert (stats['sent'], stats['retried'], stats['failed']) == (1, 4, 1)
+
+def test_other_errors_fail_straight_away():
+    async def main():
+        outbox = Outbox()
+        with pytest.raises(BadRequest):
+            await outbox.send(recorder([], 'edit', [BadRequest('Message is not modified')]), 1, EDIT)
+        await outbox.stop()
+        return outbox.stats()
+
+    stats = run(main())
+    assert (stats['retried'], stats['failed']) == (0, 1)
+
+def test_stop_cancels_calls_still_in_flight():
+    async def main():
+        outbox = Outbox()
+
+        async def hang():
+            await asyncio.sleep(60)
+
+        future = outbox.send(hang, 1)
+        await asyncio.sleep(0.05)
+        await outbox.stop(timeout=0.1)
+        return future, outbox
+
+    future, outbox = run(main())
+    assert future.cancelled()
+    assert not outbox.calls and outbox.in_flight == 0
@@ -0,0 +1,58 @@
+from wordcount import MAX_QUOTE_WORDS, WordCounter, combine_counts
+
+def count(pieces, exclude_quotes=False, exclude_bibliography=False):
+    counter = WordCounter(exclude_quotes, exclude_bibliography)
+    for piece in pieces:
+        counter.feed(piece)
+        counter.end_paragraph()
+    return counter.result()
+
+def test_counts_every_word_by_default():
+    assert count(['He said “this is quoted” and left.']) == (7, None)
+
+def test_leaves_out_curly_quotations():
+    assert count(['He said “this is quoted” and left.'], exclude_quotes=True) == (4, None)
+
+def test_leaves_out_straight_quotations_within_a_line():
+    assert count(['He said "this is quoted" and left.'], exclude_quotes=True) == (4, None)
+
+def test_unclosed_straight_quote_is_counted():
+    assert count(['A 12" ruler\nand more words'], exclude_quotes=True) == (6, None)
+
+def test_quotation_does_not_run_past_a_paragraph():
+    assert count(['He said “never closed', 'next paragraph'], exclude_quotes=True) == (6, None)
+
+def test_overlong_quotation_is_counted():
+    words = ' '.join(['word'] * (MAX_QUOTE_WORDS + 1))
+    assert count([f'Start “{words}'], exclude_quotes=True) == (MAX_QUOTE_WORDS + 2, None)
+
+def test_punctuation_after_a_quotation_is_not_a_word():
+    assert count(['He wrote “essays”. Fine'], exclude_quotes=True) == (3, None)
+
+def test_finds_the_references_heading():
+    text = 'one two three four\nReferences\nSmith 2020 a b'
+    assert count([text], exclude_bibliography=True) == (9, 4)
+    assert count([text], exclude_quotes=True, exclude_bibliography=True) == (9, 4)
+
+def test_numbered_heading_counts_as_references():
+    assert count(['one two\n2. Bibliography:\nSmith'], exclude_bibliography=True) == (5, 2)
+
+def test_heading_inside_a_line_is_not_references():
+    assert count(['see the references below'], exclude_bibliography=True) == (4, None)
+
+def test_ignores_headings_unless_excluding_the_bibliography():
+    assert count(['one two three four\nReferences\nSmith 2020 a b']) == (9, None)
+
+def test_combine_counts_drops_the_bibliography_of_the_last_part():
+    assert combine_counts([(4, None), (6, 2)]) == (6, True)
+
+def test_combine_counts_uses_the_last_heading():
+    assert combine_counts([(10, 6), (10, 5)]) == (15, True)
+
+def test_combine_counts_ignores_an_early_heading():
+    # A heading in the first half is more likely a table of contents entry
+    assert combine_counts([(1, 0), (9, None)]) == (10, False)
+
+def test_combine_counts_without_a_heading():
+    assert combine_counts([(5, None), (5, None)]) == (10, False)
+    assert combine_counts([]) == (0, False)
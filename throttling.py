@@ -0,0 +1,111 @@
+import logging
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Allows bursts of up to capacity tokens, refilled at rate tokens per second."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'warned')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.warned = False
+
+    def take(self, cost, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        self.warned = False
+        return True
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Rate limits messages per user and across the bot, and sheds document uploads when the backlog is too deep.
+
+    Documents cost more tokens than text messages since each one is
+    downloaded and parsed. A media group arrives as one message per file
+    but is a single upload, so only its first message is charged. A user's
+    bucket is dropped once it has refilled, so memory only grows with the
+    number of recently active users.
+    """
+
+    def __init__(self, user_rate=1.0, user_burst=10, global_rate=30.0, global_burst=100,
+                 text_cost=1, document_cost=5, backlog=None, max_backlog=500, sweep_interval=60, reply=None):
+        super().__init__()
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.text_cost = text_cost
+        self.document_cost = document_cost
+        self.backlog = backlog  # Callable returning the number of documents waiting to be processed
+        self.max_backlog = max_backlog
+        self.sweep_interval = sweep_interval
+        self.reply = reply or (lambda message, text: message.reply(text))  # Coroutine function sending a reply
+        now = time.monotonic()
+        self.global_bucket = TokenBucket(global_rate, global_burst, now)
+        self.user_buckets = {}
+        self.media_groups = {}  # media_group_id -> (when its first message arrived, whether it was let through)
+        self.last_sweep = now
+        self.rejected = 0
+
+    def _sweep(self, now):
+        self.last_sweep = now
+        for user_id in [user_id for user_id, bucket in self.user_buckets.items() if bucket.is_full(now)]:
+            del self.user_buckets[user_id]
+        for media_group_id in [media_group_id for media_group_id, (seen, _) in self.media_groups.items() if now - seen > self.sweep_interval]:
+            del self.media_groups[media_group_id]
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        now = time.monotonic()
+        if now - self.last_sweep > self.sweep_interval:
+            self._sweep(now)
+
+        if message.media_group_id:
+            group = self.media_groups.get(message.media_group_id)
+            if group is not None:
+                # The rest of a media group goes through, or is dropped, along with its first message
+                if group[1]:
+                    return
+                raise CancelHandler()
+            self.media_groups[message.media_group_id] = (now, False)
+
+        is_document = message.content_type == types.ContentType.DOCUMENT
+        if is_document and self.backlog is not None and self.backlog() >= self.max_backlog:
+            self.rejected += 1
+            await self.reply(message, "The bot is busy processing other documents. Please try again in a few minutes.")
+            raise CancelHandler()
+
+        cost = self.document_cost if is_document else self.text_cost
+        user_id = message.from_user.id
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self.user_buckets[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+
+        if not bucket.take(cost, now):
+            self.rejected += 1
+            # Only tell the user once, otherwise the warnings themselves would flood the chat
+            if not bucket.warned:
+                bucket.warned = True
+                await self.reply(message, "You are sending messages too quickly. Please wait a moment and try again.")
+            raise CancelHandler()
+
+        if not self.global_bucket.take(cost, now):
+            self.rejected += 1
+            logger.warning(f"Global rate limit reached, dropping message from {user_id}")
+            if is_document:
+                await self.reply(message, "The bot is busy processing other documents. Please try again in a few minutes.")
+            raise CancelHandler()
+
+        if message.media_group_id:
+            self.media_groups[message.media_group_id] = (now, True)
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import random
+
+import aiohttp
+
+class TurnitinError(Exception):
+    """Raised when Turnitin rejects a submission or a report can't be retrieved."""
+
+class TurnitinClient:
+    """Async Turnitin API client sharing one pooled keep-alive HTTP session.
+
+    At most max_concurrent documents are submitted and polled at a time.
+    Report status is polled with exponential backoff starting at
+    poll_interval seconds and capped at max_poll_interval, and a
+    submission is given up on after timeout seconds.
+    """
+
+    def __init__(self, api_url, api_key, session=None, max_concurrent=5,
+                 poll_interval=5, max_poll_interval=60, timeout=1800):
+        self.api_url = api_url.rstrip('/')
+        self.headers = {'Authorization': f'Bearer {api_key}'}
+        self.session = session
+        self.owns_session = session is None
+        self.max_concurrent = max_concurrent
+        self.semaphore = None
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+
+    def _get_session(self):
+        # Created lazily so it belongs to the event loop the client is used from
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrent * 2, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def submit(self, file_path):
+        """Uploads a document and returns its submission ID."""
+        with open(file_path, 'rb') as file:
+            form = aiohttp.FormData()
+            form.add_field('file', file, filename=os.path.basename(file_path))
+            async with self._get_session().post(f'{self.api_url}/uploads', data=form, headers=self.headers) as response:
+                if response.status != 200:
+                    raise TurnitinError(f"Failed to upload document: {await response.text()}")
+                return (await response.json()).get('submission_id')
+
+    async def wait_for_report(self, submission_id):
+        """Polls until the report for a submission is ready and returns its URL."""
+        delay = self.poll_interval
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while True:
+            async with self._get_session().get(f'{self.api_url}/submissions/{submission_id}/report', headers=self.headers) as response:
+                if response.status == 200:
+                    return (await response.json()).get('report_url')
+                elif response.status != 202:  # 202 Accepted means the report is still being generated
+                    raise TurnitinError(f"Failed to retrieve report: {await response.text()}")
+            if loop.time() + delay > deadline:
+                raise TurnitinError("Timed out waiting for the Turnitin report.")
+            # Jitter keeps many submissions from polling in lockstep
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, self.max_poll_interval)
+
+    async def check(self, file_path):
+        """Submits a document and returns the URL of its plagiarism report once it is ready."""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        async with self.semaphore:
+            submission_id = await self.submit(file_path)
+            return await self.wait_for_report(submission_id)
+
+    async def close(self):
+        if self.owns_session and self.session is not None:
+            await self.session.close()
+
+# Runs concurrent checks against a local fake Turnitin server: python turnitin.py [documents]
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import time
+    from aiohttp import web
+
+    PENDING_POLLS = 2  # Times the fake server answers 202 before a report is ready
+
+    async def main(documents):
+        polls = {}
+
+        async def upload(request):
+            form = await request.post()
+            submission_id = str(len(polls) + 1)
+            polls[submission_id] = 0
+            form['file'].file.read()
+            return web.json_response({'submission_id': submission_id})
+
+        async def report(request):
+            submission_id = request.match_info['submission_id']
+            polls[submission_id] += 1
+            if polls[submission_id] <= PENDING_POLLS:
+                return web.Response(status=202)
+            return web.json_response({'report_url': f'https://turnitin.example/reports/{submission_id}'})
+
+        app = web.Application()
+        app.router.add_post('/uploads', upload)
+        app.router.add_get('/submissions/{submission_id}/report', report)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        client = TurnitinClient(f'http://127.0.0.1:{port}', 'fake-key', poll_interval=0.05, max_poll_interval=0.2)
+        with tempfile.NamedTemporaryFile(suffix='.docx') as document:
+            document.write(b'essay' * 1000)
+            document.flush()
+            started = time.perf_counter()
+            reports = await asyncio.gather(*(client.check(document.name) for _ in range(documents)))
+            elapsed = time.perf_counter() - started
+
+        await client.close()
+        await runner.cleanup()
+        assert len(set(reports)) == documents
+        print(f"{documents} reports in {elapsed:.2f}s with at most {client.max_concurrent} submissions at once")
+
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+logger = logging.getLogger(__name__)
+
+class WebhookServer:
+    """Receives updates from Telegram over HTTPS POST instead of long polling.
+
+    Each update is acknowledged straight away and handled in a background
+    task, with at most max_concurrency handlers running at once. Once
+    max_pending updates are waiting, new ones are refused with 429 so
+    Telegram redelivers them later. On shutdown the server stops accepting
+    updates and waits for the ones already accepted.
+    """
+
+    def __init__(self, dp: Dispatcher, secret_token=None, max_concurrency=50, max_pending=1000, on_processed=None):
+        self.dp = dp
+        self.secret_token = secret_token
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_pending = max_pending
+        self.on_processed = on_processed  # Called with each update and the seconds it took to handle
+        self.tasks = set()
+        self.closing = False
+
+    async def handle(self, request: web.Request):
+        if self.secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            return web.Response(status=401)
+        if self.closing:
+            return web.Response(status=503)
+        if len(self.tasks) >= self.max_pending:
+            return web.Response(status=429)
+
+        update = types.Update(**await request.json())
+        task = asyncio.create_task(self._process(update, time.perf_counter()))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update, received_at):
+        async with self.semaphore:
+            Bot.set_current(self.dp.bot)
+            Dispatcher.set_current(self.dp)
+            try:
+                await self.dp.process_update(update)
+            except Exception:
+                logger.exception(f"Error handling update {update.update_id}")
+        if self.on_processed is not None:
+            self.on_processed(update, time.perf_counter() - received_at)
+
+    async def drain(self, timeout=30):
+        """Stops accepting updates and waits for the ones in progress."""
+        self.closing = True
+        if self.tasks:
+            logger.info(f"Waiting for {len(self.tasks)} updates to finish...")
+            await asyncio.wait(self.tasks, timeout=timeout)
+
+    def make_app(self, path):
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        return app
+
+def start_webhook(dp: Dispatcher, webhook_url, path, host, port, secret_token=None,
+                  max_concurrency=50, on_startup=None, on_shutdown=None, drain_timeout=30):
+    """Registers the webhook with Telegram and serves updates until interrupted."""
+    server = WebhookServer(dp, secret_token=secret_token, max_concurrency=max_concurrency)
+    app = server.make_app(path)
+
+    async def startup(app):
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+        await dp.bot.set_webhook(webhook_url + path, secret_token=secret_token, drop_pending_updates=True)
+        if on_startup is not None:
+            await on_startup(dp)
+
+    async def shutdown(app):
+        await server.drain(drain_timeout)
+        if on_shutdown is not None:
+            await on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    web.run_app(app, host=host, port=port)
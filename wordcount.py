@@ -0,0 +1,443 @@
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'
+
+# Parts of a DOCX file whose text is counted: the body (including tables and text boxes), headers, footers and notes
+DOCX_BODY_PART = 'word/document.xml'
+DOCX_TEXT_PARTS = re.compile(r'word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$')
+
+# A line holding nothing but one of these headings starts the bibliography
+REFERENCES_HEADING = re.compile(
+    r'^[ \t]*(?:\d+\.?[ \t]*)?(?:references|bibliography|works cited|reference list|literature cited)[ \t]*:?[ \t]*$',
+    re.IGNORECASE | re.MULTILINE,
+)
+QUOTE_MARKS = re.compile(r'([\u201c\u201d"])')
+MAX_QUOTE_WORDS = 150  # A "quote" longer than this is taken to be an unbalanced quotation mark
+BIBLIOGRAPHY_MIN_FRACTION = 0.5  # A references heading earlier than this in the document is ignored
+
+class WordCounter:
+    """Counts the words in text fed to it piece by piece, optionally leaving out quotations and the bibliography.
+
+    Each piece of text is scanned once with str.split() and a couple of
+    regular expressions, so counting stays linear in the size of the
+    document. Quoted words are held back until the closing quotation mark
+    and are given back if the quotation never closes: straight quotation
+    marks must close on the line they open on, and no quotation runs past
+    the end of a paragraph or page. The bibliography is only located here;
+    combine_counts() decides whether to drop it.
+    """
+
+    def __init__(self, exclude_quotes=False, exclude_bibliography=False):
+        self.exclude_quotes = exclude_quotes
+        self.exclude_bibliography = exclude_bibliography
+        self.words = 0
+        self.words_before_references = None  # Word count at the last references heading
+        self.quoted_words = 0
+        self.in_quote = False
+        self.quote_mark = None  # The mark that opened the current quotation
+
+    def feed(self, text):
+        if not self.exclude_quotes:
+            if self.exclude_bibliography:
+                for match in REFERENCES_HEADING.finditer(text):
+                    self.words_before_references = self.words + len(text[:match.start()].split())
+            self._count(text)
+            return
+        for line in text.split('\n'):
+            if self.exclude_bibliography and REFERENCES_HEADING.match(line):
+                # A heading is never part of a quotation
+                self.end_paragraph()
+                self.words_before_references = self.words
+            # Odd items are the quotation marks themselves
+            parts = QUOTE_MARKS.split(line)
+            for index, part in enumerate(parts):
+                if index % 2:
+                    self._quotation_mark(part)
+                elif part:
+                    # In 'essays".' the '.' is the tail of a word that has already been counted
+                    glued = index > 1 and parts[index - 2][-1:].strip() and not part[0].isspace()
+                    self._count(part, continued=bool(glued))
+            # A straight mark can't be told apart from inches or a stray keystroke, so it only opens a quotation within the line
+            if self.in_quote and self.quote_mark == '"':
+                self._unclosed_quote()
+
+    def _count(self, text, continued=False):
+        word_count = len(text.split()) - continued
+        if not self.in_quote:
+            self.words += word_count
+            return
+        self.quoted_words += word_count
+        if self.quoted_words > MAX_QUOTE_WORDS:
+            self._unclosed_quote()
+
+    def _quotation_mark(self, mark):
+        if mark == '\u201c':
+            if not self.in_quote:
+                self.in_quote = True
+                self.quote_mark = mark
+        elif self.in_quote:
+            # Closing mark: the quotation is left out of the count
+            self.in_quote = False
+            self.quoted_words = 0
+        elif mark == '"':
+            self.in_quote = True
+            self.quote_mark = mark
+
+    def _unclosed_quote(self):
+        self.words += self.quoted_words
+        self.quoted_words = 0
+        self.in_quote = False
+
+    def end_paragraph(self):
+        """Quotations don't run across paragraphs, so an open one was never closed."""
+        if self.in_quote:
+            self._unclosed_quote()
+
+    def result(self):
+        """Returns (words, words before the last references heading or None)."""
+        self.end_paragraph()
+        return self.words, self.words_before_references
+
+def combine_counts(counts):
+    """Combines the (words, words before references) results of consecutive parts of a document into its word count.
+
+    Returns (words, whether the bibliography was left out), so the user can
+    be told when no bibliography was found to exclude.
+    """
+    total = 0
+    before_references = None
+    for words, part_before_references in counts:
+        if part_before_references is not None:
+            before_references = total + part_before_references
+        total += words
+    # A heading near the start is more likely a table of contents entry than the real bibliography
+    if before_references is not None and before_references >= total * BIBLIOGRAPHY_MIN_FRACTION:
+        return before_references, True
+    return total, False
+
+def _iter_part_paragraphs(part):
+    paragraphs = []  # Text pieces of the open paragraphs; text boxes nest paragraphs inside paragraphs
+    elements = []  # Open elements, so finished ones can be detached from their parent
+    fallback_depth = 0  # Inside mc:Fallback, which repeats text already given in mc:Choice
+    for event, elem in ET.iterparse(part, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            elements.append(elem)
+            if tag == W_NS + 'p':
+                paragraphs.append([])
+            elif tag == MC_FALLBACK:
+                fallback_depth += 1
+            continue
+
+        elements.pop()
+        if tag == W_NS + 't':
+            if paragraphs and not fallback_depth and elem.text:
+                paragraphs[-1].append(elem.text)
+        elif tag in (W_NS + 'tab', W_NS + 'br', W_NS + 'cr'):
+            if paragraphs and not fallback_depth:
+                paragraphs[-1].append(' ')
+        elif tag == W_NS + 'p':
+            text = ''.join(paragraphs.pop())
+            if not fallback_depth:
+                yield text
+        elif tag == MC_FALLBACK:
+            fallback_depth -= 1
+
+        # Outside a paragraph nothing is needed any more, so keep the tree from growing
+        if not paragraphs and elements:
+            elements[-1].remove(elem)
+
+def _docx_text_parts(archive):
+    # The body comes first so the bibliography is found in reading order
+    names = [name for name in archive.namelist() if DOCX_TEXT_PARTS.match(name)]
+    return sorted(names, key=lambda name: name != DOCX_BODY_PART)
+
+def iter_docx_paragraphs(file_path):
+    """Yields the text of every paragraph in a DOCX file.
+
+    The XML parts are parsed straight out of the zip file and discarded as
+    they are read, so memory use doesn't grow with the document.
+    """
+    with zipfile.ZipFile(file_path) as archive:
+        for name in _docx_text_parts(archive):
+            with archive.open(name) as part:
+                yield from _iter_part_paragraphs(part)
+
+def count_words_in_docx(file_path, exclude_quotes=False, exclude_bibliography=False, on_text=None):
+    """Counts the number of words in a DOCX file. Returns (words, whether the bibliography was left out).
+
+    on_text, if given, is called with every paragraph as it is read.
+    """
+    body = WordCounter(exclude_quotes, exclude_bibliography)
+    # Headers, footers and notes don't belong to the bibliography even though they come after it
+    other_parts = WordCounter(exclude_quotes)
+    with zipfile.ZipFile(file_path) as archive:
+        for name in _docx_text_parts(archive):
+            counter = body if name == DOCX_BODY_PART else other_parts
+            with archive.open(name) as part:
+                for text in _iter_part_paragraphs(part):
+                    counter.feed(text)
+                    counter.end_paragraph()
+                    if on_text is not None:
+                        on_text(text)
+    words, bibliography_excluded = combine_counts([body.result()])
+    return words + other_parts.result()[0], bibliography_excluded
+
+def load_pdf_backend():
+    """Imports PyMuPDF on first use and returns it.
+
+    It is slow to import, so the bot doesn't load it at startup; extraction
+    worker processes call this as their initializer instead.
+    """
+    import fitz  # PyMuPDF
+    return fitz
+
+def preload_backends():
+    """Initializer for extraction worker processes, so the first document doesn't wait for imports."""
+    load_pdf_backend()
+
+def iter_pdf_pages(file_path):
+    """Yields the text of every page in a PDF file, one page at a time."""
+    with load_pdf_backend().open(file_path) as doc:
+        for page in doc:
+            yield page.get_text()
+
+def count_words_in_pdf(file_path, exclude_quotes=False, exclude_bibliography=False, on_text=None):
+    """Counts the number of words in a PDF file. Returns (words, whether the bibliography was left out).
+
+    on_text, if given, is called with the text of every page as it is read.
+    """
+    counter = WordCounter(exclude_quotes, exclude_bibliography)
+    for text in iter_pdf_pages(file_path):
+        counter.feed(text)
+        counter.end_paragraph()
+        if on_text is not None:
+            on_text(text)
+    return combine_counts([counter.result()])
+
+def count_pdf_pages(file_path):
+    """Returns the number of pages in a PDF file."""
+    with load_pdf_backend().open(file_path) as doc:
+        return doc.page_count
+
+def pdf_page_ranges(page_count, pages_per_chunk):
+    """Splits the pages of a PDF into (start, stop) ranges of at most pages_per_chunk pages."""
+    return [(start, min(start + pages_per_chunk, page_count))
+            for start in range(0, page_count, pages_per_chunk)]
+
+def count_words_in_pdf_pages(file_path, start, stop, exclude_quotes=False, exclude_bibliography=False, on_text=None):
+    """Counts the words on pages start..stop-1 of a PDF file.
+
+    Returns (words, words before the last references heading or None) for
+    combine_counts(). Each call opens the document itself so page ranges
+    can be counted in separate worker processes, and only one page of text
+    is held at a time. Quotations end with the page, as in
+    count_words_in_pdf(), so the result doesn't depend on the ranges.
+    on_text, if given, is called with the text of every page.
+    """
+    counter = WordCounter(exclude_quotes, exclude_bibliography)
+    with load_pdf_backend().open(file_path) as doc:
+        for page_number in range(start, stop):
+            text = doc.load_page(page_number).get_text()
+            counter.feed(text)
+            counter.end_paragraph()
+            if on_text is not None:
+                on_text(text)
+    return counter.result()
+
+def iter_document_text(file_path):
+    """Yields the text of a DOCX file paragraph by paragraph, or of a PDF file page by page."""
+    if file_path.endswith('.docx'):
+        return iter_docx_paragraphs(file_path)
+    elif file_path.endswith('.pdf'):
+        return iter_pdf_pages(file_path)
+    else:
+        raise ValueError("Unsupported file type. Please upload a DOCX or PDF file.")
+
+def count_words(file_path, exclude_quotes=False, exclude_bibliography=False, on_text=None):
+    """Determines the file type and counts words accordingly. Returns (words, whether the bibliography was left out)."""
+    if file_path.endswith('.docx'):
+        return count_words_in_docx(file_path, exclude_quotes, exclude_bibliography, on_text)
+    elif file_path.endswith('.pdf'):
+        return count_words_in_pdf(file_path, exclude_quotes, exclude_bibliography, on_text)
+    else:
+        raise ValueError("Unsupported file type. Please upload a DOCX or PDF file.")
+
+# Benchmarks: python wordcount.py
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import textwrap
+    import time
+    import tracemalloc
+    from concurrent.futures import ProcessPoolExecutor
+
+    fitz = load_pdf_backend()
+
+    SAMPLE_LINE = "The quick brown fox jumps over the lazy dog while students write essays."
+
+    def make_pdf(file_path, pages, lines=None, cjk_font=False):
+        """Writes a PDF of SAMPLE_LINE repeated over the given number of pages, or of the given lines.
+
+        The built-in Latin fonts have no curly quotation marks, so cjk_font
+        switches to a font that has them, wrapping lines to fit its wider
+        glyphs. A wrapped line is kept on one page, as quotations end with
+        the page.
+        """
+        lines = lines or [SAMPLE_LINE] * (pages * 40)
+        page_lines = [[]]
+        for line in lines:
+            wrapped = textwrap.wrap(line, 60) if cjk_font else [line]
+            if len(page_lines[-1]) + len(wrapped) > 40:
+                page_lines.append([])
+            page_lines[-1] += wrapped
+        doc = fitz.open()
+        for lines_on_page in page_lines:
+            page = doc.new_page()
+            for number, line in enumerate(lines_on_page):
+                if cjk_font:
+                    page.insert_text((50, 60 + number * 18), line, fontsize=6, fontname='china-s')
+                else:
+                    page.insert_text((50, 60 + number * 18), line, fontsize=10)
+        doc.save(file_path)
+
+    def make_essay(paragraphs, references, messy_every=0):
+        """Returns the lines of an essay with a quotation in every paragraph and a reference list,
+        with the expected word counts for each combination of (exclude_quotes, exclude_bibliography).
+
+        With messy_every, every that many paragraphs are followed by a line
+        with a stray straight quotation mark and one quoting a heading word.
+        """
+        body = "Students often argue that the evidence supports the claim, and as one author wrote"
+        quote = "\u201cthe results were clear and consistent\u201d"
+        reference = 'Smith, J. (2020). "A study of essays". Journal of Writing, 12(3), 45-67.'
+        stray = 'The shelf is 12" wide and holds every essay we wrote.'
+        quoted_heading = 'As the "Bibliography" section shows, these sources matter.'
+        body_words, quote_words = len(body.split()), len(quote.split())
+        reference_words, reference_quote_words = len(reference.split()), len('A study of essays'.split())
+        lines = []
+        for number in range(1, paragraphs + 1):
+            lines.append(f"{body} {quote} today.")
+            if messy_every and number % messy_every == 0:
+                lines += [stray, quoted_heading]
+        lines += ["References"] + [reference] * references
+        messy = paragraphs // messy_every if messy_every else 0
+        body_total = paragraphs * (body_words + 1) + messy * (len(stray.split()) + len(quoted_heading.split()))
+        expected = {
+            (False, False): body_total + paragraphs * quote_words + 1 + references * reference_words,
+            (True, False): body_total - messy + 1 + references * (reference_words - reference_quote_words),
+            (False, True): body_total + paragraphs * quote_words,
+            (True, True): body_total - messy,
+        }
+        return lines, expected
+
+    def make_docx(file_path, paragraphs, lines=None):
+        """Writes a minimal DOCX with the given number of paragraphs, plus a table row every 50 paragraphs.
+
+        If lines is given, each of them becomes a paragraph instead.
+        """
+        paragraph = f'<w:p><w:r><w:t>{SAMPLE_LINE}</w:t></w:r><w:r><w:tab/><w:t xml:space="preserve">More text. </w:t></w:r></w:p>'
+        table_row = f'<w:tbl><w:tr><w:tc>{paragraph}</w:tc><w:tc>{paragraph}</w:tc></w:tr></w:tbl>'
+        with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('[Content_Types].xml',
+                '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="xml" ContentType="application/xml"/>'
+                '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+                '</Types>')
+            archive.writestr('_rels/.rels',
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+                '</Relationships>')
+            with archive.open('word/document.xml', 'w') as part:
+                part.write(b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>')
+                if lines is not None:
+                    for line in lines:
+                        part.write(f'<w:p><w:r><w:t xml:space="preserve">{line}</w:t></w:r></w:p>'.encode())
+                for number in range(paragraphs):
+                    part.write((table_row if number % 50 == 49 else paragraph).encode())
+                part.write(b'</w:body></w:document>')
+
+    def count_words_with_python_docx(file_path):
+        from docx import Document
+        doc = Document(file_path)
+        return sum(len(para.text.split()) for para in doc.paragraphs)
+
+    def measure(func, *args):
+        tracemalloc.start()
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return result, elapsed, peak / 1024 / 1024
+
+    def count_words_in_pdf_parallel(pool, file_path, pages_per_chunk=25):
+        ranges = pdf_page_ranges(count_pdf_pages(file_path), pages_per_chunk)
+        futures = [pool.submit(count_words_in_pdf_pages, file_path, start, stop) for start, stop in ranges]
+        return combine_counts(future.result() for future in futures)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print("DOCX word counting (streaming vs python-docx; python-docx skips tables)")
+        for paragraphs in (1000, 10000, 100000):
+            file_path = os.path.join(tmp, f"{paragraphs}.docx")
+            make_docx(file_path, paragraphs)
+            (words, _), elapsed, peak = measure(count_words_in_docx, file_path)
+            print(f"{paragraphs:>7} paragraphs: streaming {words} words in {elapsed:.3f}s, peak {peak:.1f} MB", end='')
+            try:
+                words, elapsed, peak = measure(count_words_with_python_docx, file_path)
+                print(f"; python-docx {words} words in {elapsed:.3f}s, peak {peak:.1f} MB")
+            except ImportError:
+                print("; python-docx not installed")
+
+        with ProcessPoolExecutor() as pool:
+            print(f"PDF word counting ({os.cpu_count()} CPUs)")
+            for pages in (10, 100, 1000):
+                file_path = os.path.join(tmp, f"{pages}.pdf")
+                make_pdf(file_path, pages)
+
+                started = time.perf_counter()
+                sequential = count_words_in_pdf(file_path)
+                sequential_time = time.perf_counter() - started
+
+                started = time.perf_counter()
+                parallel = count_words_in_pdf_parallel(pool, file_path)
+                parallel_time = time.perf_counter() - started
+
+                assert sequential == parallel
+                print(f"{pages:>5} pages: {sequential[0]} words, sequential {sequential_time:.3f}s, page-parallel {parallel_time:.3f}s")
+
+        def count_words_in_pdf_chunks(file_path, exclude_quotes, exclude_bibliography, pages_per_chunk=3):
+            """Counts a PDF the way the bot does, in page ranges that are combined afterwards."""
+            return combine_counts(count_words_in_pdf_pages(file_path, start, stop, exclude_quotes, exclude_bibliography)
+                                  for start, stop in pdf_page_ranges(count_pdf_pages(file_path), pages_per_chunk))
+
+        print("Quote and bibliography exclusion (expected vs counted)")
+        for name, messy_every in (('essay', 0), ('messy_essay', 7)):
+            lines, expected = make_essay(paragraphs=400, references=60, messy_every=messy_every)
+            make_docx(os.path.join(tmp, f'{name}.docx'), 0, lines)
+            make_pdf(os.path.join(tmp, f'{name}.pdf'), 0, lines, cjk_font=True)
+            for label, func, extension in (('docx', count_words, 'docx'), ('pdf', count_words, 'pdf'),
+                                           ('pdf in chunks', count_words_in_pdf_chunks, 'pdf')):
+                for (exclude_quotes, exclude_bibliography), words in expected.items():
+                    counted, _ = func(os.path.join(tmp, f'{name}.{extension}'), exclude_quotes, exclude_bibliography)
+                    print(f"{name} {label:>13} exclude quotes={exclude_quotes!s:<5} bibliography={exclude_bibliography!s:<5}: "
+                          f"expected {words}, counted {counted}{'' if counted == words else '  <-- MISMATCH'}")
+
+        # A reference list longer than the body can't be told apart from a table of contents entry, so it is counted
+        lines, expected = make_essay(paragraphs=20, references=60)
+        make_docx(os.path.join(tmp, 'short_essay.docx'), 0, lines)
+        counted, bibliography_excluded = count_words(os.path.join(tmp, 'short_essay.docx'), False, True)
+        print(f"Short essay with a long reference list: counted {counted} (all {expected[False, False]} words), "
+              f"bibliography excluded: {bibliography_excluded}")
+
+        lines, _ = make_essay(paragraphs=17000, references=700)
+        file_path = os.path.join(tmp, 'long_essay.pdf')
+        make_pdf(file_path, 0, lines, cjk_font=True)
+        for options in ((False, False), (True, True)):
+            started = time.perf_counter()
+            count_words_in_pdf(file_path, *options)
+            print(f"{count_pdf_pages(file_path)} page essay, exclude quotes and bibliography={options[0]}: {time.perf_counter() - started:.3f}s")